@@ -1,18 +1,61 @@
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from xml.etree import ElementTree as ET
+from contextlib import nullcontext
+from collections import deque
 from utils import get_existing_assets
+from tile_plan import TilePlan, DONE, FAILED, EMPTY
+from metrics import RunMetrics
+import workspace
+from scheduler import host_of, AdaptiveLimit, TokenBucket
+import history
 from osgeo import gdal
 from config import *
+from xml.sax.saxutils import escape
+from requests.adapters import HTTPAdapter
 import numpy as np
 import requests
-import boto3
+import multiprocessing
+import threading
+import hashlib
+import shutil
+import config
+import uuid
 import json
+import math
 import time
 import sys
 import os
 
 
 previous_line_len = 0
+# 'tiles' downloads one GetMap per bbox and merges them, 'gdal' lets the GDAL WMS driver fetch the whole layer
+WMS_ENGINE = getattr(config, 'WMS_ENGINE', 'tiles')
+GDAL_MAX_CONNECTIONS = getattr(config, 'GDAL_MAX_CONNECTIONS', 8)
+# Threads waiting on the GetMap requests and processes decoding/encoding the tiles of the 'staged' engine
+FETCH_WORKERS = getattr(config, 'FETCH_WORKERS', 8)
+ENCODE_WORKERS = getattr(config, 'ENCODE_WORKERS', os.cpu_count() or 2)
+# The fetchers of the 'staged' engine start with a couple of requests in flight and adapt to the server, up to FETCH_WORKERS
+ADAPTIVE_FETCH = getattr(config, 'ADAPTIVE_FETCH', True)
+# Average download rate cap in bytes per second, e.g. 2_000_000 during office hours. None for no cap
+BANDWIDTH_LIMIT = getattr(config, 'BANDWIDTH_LIMIT', None)
+# A GetMap slower than this percentile of the run gets a duplicate request, for at most HEDGE_BUDGET of the requests
+HEDGE_PERCENTILE = getattr(config, 'HEDGE_PERCENTILE', 0.95)
+HEDGE_BUDGET = getattr(config, 'HEDGE_BUDGET', 0.05)
+# Overviews of the output fetched from the WMS with coarser grids, instead of downsampled from the mosaic
+WMS_OVERVIEWS = getattr(config, 'WMS_OVERVIEWS', False)
+# Upload a low resolution version of the layer first, replaced by the full build when it is ready
+PREVIEW_FIRST = getattr(config, 'PREVIEW_FIRST', False)
+PREVIEW_QUADRANTS = getattr(config, 'PREVIEW_QUADRANTS', 2)
+# Length of a degree of latitude, used to convert the EPSG:4326 extents to metres
+METRES_PER_DEGREE = 111320
+# Shared by every request of the process so that connections are kept alive. The pool
+# holds a connection for each request the staged engine can have in flight, hedges included
+http = requests.Session()
+http.mount('http://', HTTPAdapter(pool_maxsize=2 * FETCH_WORKERS))
+http.mount('https://', HTTPAdapter(pool_maxsize=2 * FETCH_WORKERS))
+# Token of the last get_token call and the time (epoch seconds) it stops being valid
+token_cache = {'token': None, 'expires': 0}
 
 
 def exists(name, id=None):
@@ -47,7 +90,7 @@ def create_new_asset(name, url, description):
         }
     }
 
-    response = requests.post(CESIUM_BASE_URL, headers=HEADERS["with_payload"], data=json.dumps(payload))
+    response = http.post(CESIUM_BASE_URL, headers=HEADERS["with_payload"], data=json.dumps(payload))
     response_data = response.json()
 
     if response.status_code == 201 or response.status_code == 200:
@@ -84,11 +127,14 @@ def create_new_asset(name, url, description):
         print(f"Error:{response.status_code}:{response_data}")
 
 
-def get_token():
+def get_token(refresh=False):
     """This function takes the username and password from the env file
     and makes a request to webgis.abdac to gather the token that will be used
-    in the following requests
+    in the following requests. The token is reused until a few minutes before
+    it expires, unless refresh is True
     """
+    if not refresh and token_cache['token'] and time.time() < token_cache['expires'] - 300:
+        return token_cache['token']
     url = "https://webgis.abdac.it/portal/sharing/rest/generateToken"
     payload = {
         "username": USERNAME,
@@ -103,9 +149,12 @@ def get_token():
         "Content-Type": "application/x-www-form-urlencoded"
     }
     try:
-        response = requests.post(url, data=payload, headers=headers)
+        response = http.post(url, data=payload, headers=headers)
 
         g_token = response.json()["token"]
+        # expires is in milliseconds, the requested expiration in minutes
+        token_cache['expires'] = response.json().get('expires', (time.time() + payload['expiration'] * 60) * 1000) / 1000
+        token_cache['token'] = g_token
     except Exception as e:
         print(f'Something went wrong when requesting the token: {str(e)}')
         time.sleep(2)
@@ -113,18 +162,19 @@ def get_token():
     return g_token
 
 
-def get_capabilities(base_url, use_token=False, qs=4):
+def get_capabilities(base_url, use_token=False, qs=4, rows=None):
     """This function makes a request to the WMS, using the token if needed,
-    to obtain the Capabilities of the layer"""
+    to obtain the Capabilities of the layer. The plan splits the extent in
+    qs columns and rows rows (qs if not given)"""
     capabilities_url = f'{base_url}?service=WMS&version=1.3.0&request=GetCapabilities'
 
     try:
         if use_token:
             g_token = get_token()
             capabilities_url += f"&token={g_token}"
-            response = requests.get(capabilities_url)
+            response = http.get(capabilities_url)
         else:
-            response = requests.get(capabilities_url)
+            response = http.get(capabilities_url)
             
     except Exception as e:
         print(f'Error: {str(e)}')
@@ -147,24 +197,80 @@ def get_capabilities(base_url, use_token=False, qs=4):
     miny = float(capabilities.find('.//ns0:BoundingBox', namespace).attrib.get('miny'))
     maxy = float(capabilities.find('.//ns0:BoundingBox', namespace).attrib.get('maxy'))
 
-    n_of_quadrants = qs
+    cap_dict['extent'] = (minx, miny, maxx, maxy)
+    cap_dict['plan'] = TilePlan.grid(cap_dict['extent'], qs, rows)
 
-    cap_dict['bboxes'] = []
+    cap_dict['title'] = capabilities.find('.//ns0:Title', namespace).text
+    return cap_dict
 
-    step_x = (maxx - minx) / n_of_quadrants
-    step_y = (maxy - miny) / n_of_quadrants
 
-    for i in range(n_of_quadrants):
-        for j in range(n_of_quadrants):
-            bbox_minx = minx + j * step_x
-            bbox_maxx = minx + (j + 1) * step_x
-            bbox_miny = miny + i * step_y
-            bbox_maxy = miny + (i + 1) * step_y
+def get_bboxes(minx, miny, maxx, maxy, n_of_quadrants, n_of_rows=None):
+    """This function splits the extent of the layer in a grid of
+    n_of_quadrants columns x n_of_rows rows (a square grid if n_of_rows
+    is not given) of bounding boxes, formatted as 'miny,minx,maxy,maxx'
+    strings for the GetMap requests. The edges are computed once and shared
+    by the neighbouring tiles, so that with tiles of the same size in pixels
+    they all lie on the same pixel lattice, without overlaps or gaps
+    """
+    return TilePlan.grid((minx, miny, maxx, maxy), n_of_quadrants, n_of_rows).bboxes()
 
-            cap_dict['bboxes'].append(f'{bbox_miny},{bbox_minx},{bbox_maxy},{bbox_maxx}')
 
-    cap_dict['title'] = capabilities.find('.//ns0:Title', namespace).text
-    return cap_dict
+def grid_size(extent, quadrant_size, target_resolution=None, max_pixels=None, quadrants=N_QUADRANTS):
+    """This function returns the (columns, rows) of quadrant_size tiles needed
+    to cover the extent at target_resolution metres per pixel, coarsened if
+    needed so that the mosaic has max_pixels pixels at most. Without either
+    of them the grid is quadrants x quadrants, as for every layer before
+    """
+    if not target_resolution and not max_pixels:
+        return quadrants, quadrants
+    minx, miny, maxx, maxy = extent
+    width = (maxx - minx) * METRES_PER_DEGREE * math.cos(math.radians((miny + maxy) / 2))
+    height = (maxy - miny) * METRES_PER_DEGREE
+    if target_resolution:
+        columns = max(1, math.ceil(width / float(target_resolution) / quadrant_size))
+        rows = max(1, math.ceil(height / float(target_resolution) / quadrant_size))
+    else:
+        # The aspect of the extent, with as many tiles as max_pixels allows
+        columns, rows = width / quadrant_size, height / quadrant_size
+    if max_pixels:
+        scale = math.sqrt(float(max_pixels) / (columns * rows * quadrant_size ** 2))
+        if scale < 1 or not target_resolution:
+            columns, rows = max(1, math.floor(columns * scale)), max(1, math.floor(rows * scale))
+    return columns, rows
+
+
+def build_wms_xml(wms_url, extent, size_x, size_y, block_x, block_y, g_token, max_connections=GDAL_MAX_CONNECTIONS):
+    """This function builds the GDAL WMS service description of the whole layer,
+    so that GDAL can split it in GetMap requests of block_x x block_y pixels
+    and fetch them itself, with max_connections requests in parallel
+    """
+    minx, miny, maxx, maxy = extent
+    return f'''<GDAL_WMS>
+    <Service name="WMS">
+        <Version>1.3.0</Version>
+        <ServerUrl>{escape(f'{wms_url}?token={g_token}')}</ServerUrl>
+        <CRS>EPSG:4326</CRS>
+        <ImageFormat>image/png</ImageFormat>
+        <Transparent>TRUE</Transparent>
+        <Layers>0</Layers>
+        <Styles>default</Styles>
+        <BBoxOrder>yxYX</BBoxOrder>
+    </Service>
+    <DataWindow>
+        <UpperLeftX>{minx!r}</UpperLeftX>
+        <UpperLeftY>{maxy!r}</UpperLeftY>
+        <LowerRightX>{maxx!r}</LowerRightX>
+        <LowerRightY>{miny!r}</LowerRightY>
+        <SizeX>{size_x}</SizeX>
+        <SizeY>{size_y}</SizeY>
+    </DataWindow>
+    <Projection>EPSG:4326</Projection>
+    <BandsCount>4</BandsCount>
+    <BlockSizeX>{block_x}</BlockSizeX>
+    <BlockSizeY>{block_y}</BlockSizeY>
+    <MaxConnections>{max_connections}</MaxConnections>
+    <ZeroBlockHttpCodes>204,404</ZeroBlockHttpCodes>
+</GDAL_WMS>'''
 
 
 def set_transparency(input_tiff, output_tiff, transparency):
@@ -215,11 +321,11 @@ def set_transparency(input_tiff, output_tiff, transparency):
     out_dataset = None
 
 
-def merge_tiffs(files, output_file):
+def merge_tiffs(files, output_file, delete_temp_files=DELETE_TEMP_FILES, workspace_name=None):
     """This function merges the temp files obtained with the split requests
     into a single tiff file. If the process is successfull and the variable
-    delete_temp_files is set to True, it will also delete the temp folder
-    and its content
+    delete_temp_files is set to True, it will also delete the temp files and,
+    if workspace_name is given, the workspace of that layer once empty
     """
     try:
         # print("Merging TIFF files...", end='\r', flush=True)
@@ -236,13 +342,14 @@ def merge_tiffs(files, output_file):
         # print(f"TIFF files merged successfully into {dest}", end='\r', flush=True)
         sys.stdout.flush()
 
-        if DELETE_TEMP_FILES:
+        if delete_temp_files:
             for file in files:
                 if os.path.exists(file):
                     os.remove(file)
-            subdir = os.path.join(FILES_DIR, f'temp_{output_file.replace('.tiff', '')}')
-            if os.listdir(subdir) == []:
-                os.removedirs(subdir)
+            if workspace_name is not None:
+                subdir = workspace.workspace_path(workspace_name)
+                if os.path.isdir(subdir) and os.listdir(subdir) == []:
+                    os.rmdir(subdir)
 
     except Exception as e:
         print(f"Error during merging: {str(e)}")
@@ -252,41 +359,501 @@ def merge_tiffs(files, output_file):
         sys.exit(0)
 
 
-def retry_download(bbox, i, wms_url, g_token, wh, temp_output_tiff, output_files):
-    """If some chunk requests have failed this function will 
-    try to download those parts of the file again"""
+def mosaic_tiffs(files, output_file, extent, columns, rows, tile_size, delete_temp_files=DELETE_TEMP_FILES,
+                 workspace_name=None):
+    """This function assembles the tiles of a columns x rows grid of
+    tile_size pixels, covering extent, into a single tiff by copying each
+    one at its pixel offset, without the resampling of merge_tiffs. The
+    tiles that are missing stay transparent. If a tile is not on the
+    pixel lattice of the grid the files are merged with merge_tiffs instead.
+    With delete_temp_files each tile is deleted as soon as it is copied, and
+    the workspace of the layer workspace_name, if given, once it is empty
+    """
+    minx, miny, maxx, maxy = extent
+    width, height = columns * tile_size, rows * tile_size
+    pixel_x, pixel_y = (maxx - minx) / width, (maxy - miny) / height
+
+    offsets = []
+    for file in files:
+        dataset = gdal.Open(file)
+        geotransform = dataset.GetGeoTransform()
+        xoff = (geotransform[0] - minx) / pixel_x
+        yoff = (maxy - geotransform[3]) / pixel_y
+        # Anything further than a hundredth of a pixel from the lattice would need resampling
+        if (dataset.RasterXSize, dataset.RasterYSize) != (tile_size, tile_size) or \
+                abs(xoff - round(xoff)) > 0.01 or abs(yoff - round(yoff)) > 0.01:
+            dataset = None
+            return merge_tiffs(files, output_file, delete_temp_files, workspace_name)
+        offsets.append((file, round(xoff), round(yoff)))
+        dataset = None
+    # The VRTs of the duplicated tiles first, while the tiles they show still exist
+    offsets.sort(key=lambda offset: not offset[0].endswith('.vrt'))
+
     try:
-        options = [
-                    '-co', 'ALPHA=YES',
-                    '-co', 'TILED=YES',
-                    '-co', 'COMPRESS=LZW'
-                ]
+        dest = os.path.join(FILES_DIR, output_file)
+        driver = gdal.GetDriverByName('GTiff')
+        out_dataset = driver.Create(dest, width, height, 4, gdal.GDT_Byte, [
+            'COMPRESS=LZW',
+            'TILED=YES',
+            'ALPHA=YES',
+            'BIGTIFF=IF_SAFER'
+        ])
+        out_dataset.SetGeoTransform((minx, pixel_x, 0, maxy, 0, -pixel_y))
+        out_dataset.SetProjection('EPSG:4326')
+        for file, xoff, yoff in offsets:
+            dataset = gdal.Open(file)
+            out_dataset.WriteArray(dataset.ReadAsArray(), xoff, yoff)
+            dataset = None
+            if delete_temp_files:
+                os.remove(file)
+        out_dataset = None
+
+        if delete_temp_files and workspace_name is not None:
+            subdir = workspace.workspace_path(workspace_name)
+            if os.path.isdir(subdir) and os.listdir(subdir) == []:
+                os.rmdir(subdir)
+
+    except Exception as e:
+        print(f"Error during merging: {str(e)}")
+        print('Exiting...')
+        sys.stdout.flush()
+        time.sleep(2)
+        sys.exit(0)
+
 
-        width, height = wh, wh
+def pixel_fingerprint(path, chunk_rows=1024):
+    """This function hashes the pixels of a raster, with its size and
+    georeferencing, reading chunk_rows lines at a time. Two files with the
+    same fingerprint show the same image, even if their compression or
+    metadata differ
+    """
+    dataset = gdal.Open(path)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f'{dataset.RasterXSize}x{dataset.RasterYSize}x{dataset.RasterCount}'.encode())
+    digest.update(repr(dataset.GetGeoTransform()).encode())
+    for yoff in range(0, dataset.RasterYSize, chunk_rows):
+        rows = min(chunk_rows, dataset.RasterYSize - yoff)
+        digest.update(dataset.ReadRaster(0, yoff, dataset.RasterXSize, rows))
+    dataset = None
+    return digest.hexdigest()
 
-        wms_url_with_size = f'{wms_url}?SERVICE=WMS&VERSION=1.3.0&REQUEST=GetMap&styles=default&LAYERS=0&WIDTH={width}&HEIGHT={height}\
-            &FORMAT=image/png&TRANSPARENT=true&CRS=EPSG:4326&BBOX={bbox}&token={g_token}'
 
-        wms_dataset = gdal.Open(wms_url_with_size)
+def format_eta(eta):
+    """This function formats the seconds left as the ETA shown while downloading"""
+    eta_finish = datetime.now() + timedelta(seconds=eta)
+    if eta < 60:
+        return f'~ {int(eta)} seconds remaining (finishes downloading at around: {eta_finish.strftime("%H:%M:%S")})'
+    elif eta < 3600:
+        return f'~ {round(eta/60, 2)} minutes remaining (finishes downloading at around: {eta_finish.strftime("%H:%M:%S")})'
+    return f'~ {round(eta/3600, 2)} hours remaining (finishes downloading at around: {eta_finish.strftime("%H:%M:%S")})'
 
-        if wms_dataset is None:
-            print("GDAL failed to open the WMS dataset.")
-            sys.stdout.flush()
-            return
 
+def pyramid_levels(columns, rows):
+    """This function returns the (factor, columns, rows) of the coarser grids
+    that cover the layer with the same tile size: each one halves the
+    resolution of the previous one and needs a quarter of its requests
+    """
+    levels = []
+    factor = 2
+    while columns % factor == 0 and rows % factor == 0:
+        levels.append((factor, columns // factor, rows // factor))
+        factor *= 2
+    return levels
+
+
+def fetch_level(wms_url, extent, columns, rows, quadrant_size, g_token, output_tiff, metrics=None, limiter=None):
+    """This function fetches the whole layer with a grid of columns x rows
+    tiles of quadrant_size pixels and merges them into output_tiff (an absolute
+    path). Coarse grids give low resolution versions of the layer in few requests
+    """
+    files = []
+    plan = TilePlan.grid(extent, columns, rows)
+    for idx in range(len(plan)):
+        i = idx + 1
+        tile_tiff = output_tiff.replace('.tiff', f'_{i}.tiff')
+        files.append(fetch_tile(wms_url, plan.bbox(idx), quadrant_size, quadrant_size, g_token, tile_tiff,
+                                metrics=metrics, tile=f'{columns}x{rows}:{i}', limiter=limiter))
+    # The workspace the level is written in belongs to the layer, its caller removes it
+    mosaic_tiffs(files, output_tiff, extent, columns, rows, quadrant_size, delete_temp_files=True)
+    return output_tiff
+
+
+def write_overviews(output_tiff, level_files):
+    """This function adds overviews to output_tiff whose pixels are copied from
+    the level files ({factor: path}) instead of being computed from the full
+    resolution data
+    """
+    gdal.SetConfigOption('COMPRESS_OVERVIEW', 'LZW')
+    dataset = gdal.Open(output_tiff, gdal.GA_Update)
+    factors = sorted(level_files)
+    # NONE only allocates the overviews, their content is written below
+    dataset.BuildOverviews('NONE', factors)
+    for n, factor in enumerate(factors):
+        overview = dataset.GetRasterBand(1).GetOverview(n)
+        level = gdal.Translate('', level_files[factor], format='MEM', width=overview.XSize, height=overview.YSize)
+        for band in range(1, dataset.RasterCount + 1):
+            dataset.GetRasterBand(band).GetOverview(n).WriteArray(level.GetRasterBand(band).ReadAsArray())
+        level = None
+    dataset.FlushCache()
+    dataset = None
+
+
+def fetch_tile_bytes(wms_url, bbox, width, height, g_token, record=None):
+    """This function makes the GetMap request of a bbox and returns the PNG it
+    receives, without decoding it. It raises if the server answers with an
+    error, which ArcGIS sends as an XML document with status 200. The HTTP
+    status is stored in record, if given
+    """
+    params = {
+        'SERVICE': 'WMS', 'VERSION': '1.3.0', 'REQUEST': 'GetMap', 'styles': 'default', 'LAYERS': '0',
+        'WIDTH': width, 'HEIGHT': height, 'FORMAT': 'image/png', 'TRANSPARENT': 'true',
+        'CRS': 'EPSG:4326', 'BBOX': bbox, 'token': g_token
+    }
+    response = http.get(wms_url, params=params, timeout=300)
+    if record is not None:
+        record['status'] = response.status_code
+    response.raise_for_status()
+    if not response.headers.get('Content-Type', '').startswith('image/'):
+        raise RuntimeError(f'GetMap did not return an image: {response.text[:200]}')
+    return response.content
+
+
+class HedgePolicy:
+    """Decides when a GetMap request deserves a duplicate: once it has taken
+    longer than the given percentile of the latencies seen during the run,
+    as long as the duplicates stay under budget (a fraction of the requests)
+    """
+    def __init__(self, percentile=HEDGE_PERCENTILE, budget=HEDGE_BUDGET, min_samples=20):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.latencies = deque(maxlen=500)
+        self.requests = 0
+        self.hedges = 0
+        self._lock = threading.Lock()
+
+    def threshold(self):
+        """Returns the latency after which a request is hedged, None until
+        enough requests have completed to measure it"""
+        with self._lock:
+            if len(self.latencies) < self.min_samples:
+                return None
+            return float(np.quantile(list(self.latencies), self.percentile))
+
+    def observe(self, seconds):
+        with self._lock:
+            self.requests += 1
+            self.latencies.append(seconds)
+
+    def allow(self):
+        """Takes a duplicate from the budget, if there is any left"""
+        with self._lock:
+            if self.hedges + 1 > self.budget * max(self.requests, 1):
+                return False
+            self.hedges += 1
+            return True
+
+
+def fetch_tile_bytes_hedged(pool, hedge, wms_url, bbox, width, height, g_token, record=None, limiter=None, window=None):
+    """Same as fetch_tile_bytes, but if the request is still running after
+    the threshold of hedge a second identical one is sent on pool and the
+    first answer wins. The other one is cancelled if it has not started yet,
+    otherwise its answer is dropped. The caller must already hold a slot of
+    limiter and a place in window for the first request; the second one
+    needs its own, free right away, or it is not sent. Each request gives
+    its slot and place back, reports its response to window and its latency
+    to hedge when it actually ends, even after the other one has won
+    """
+    statuses = [{}]
+
+    def release():
+        if window is not None:
+            window.release()
+        if limiter is not None:
+            limiter.release(wms_url)
+
+    def attempt(status):
+        start = time.perf_counter()
+        ok = False
+        try:
+            content = fetch_tile_bytes(wms_url, bbox, width, height, g_token, status)
+            ok = True
+            return content
+        finally:
+            seconds = time.perf_counter() - start
+            hedge.observe(seconds)
+            if window is not None:
+                window.on_response(seconds, status.get('status'), ok)
+            release()
+
+    def acquire():
+        if limiter is not None and not limiter.try_acquire(wms_url):
+            return False
+        if window is not None and not window.try_acquire():
+            if limiter is not None:
+                limiter.release(wms_url)
+            return False
+        return True
+
+    try:
+        futures = [pool.submit(attempt, statuses[0])]
+    except BaseException:
+        release()
+        raise
+    threshold = hedge.threshold()
+    if threshold is not None and not wait(futures, timeout=threshold).done and acquire():
+        if not hedge.allow():
+            release()
+        else:
+            statuses.append({})
+            futures.append(pool.submit(attempt, statuses[1]))
+            if record is not None:
+                record['hedged'] = True
+    pending = list(futures)
+    while True:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        future = done.pop()
+        pending.remove(future)
+        # A failed attempt only counts if there is no other one left to wait for
+        if future.exception() is None or not pending:
+            break
+    for other in pending:
+        # A request that never started gives its slots back here
+        if other.cancel():
+            release()
+    status = statuses[futures.index(future)]
+    if record is not None and 'status' in status:
+        record['status'] = status['status']
+    return future.result()
+
+
+def encode_tile(content, bbox, width, height, output_tiff, transparency=0.5):
+    """This function decodes a GetMap PNG, georeferences it with its bbox
+    ('miny,minx,maxy,maxx' in EPSG:4326), applies the transparency and writes
+    it as an LZW GeoTIFF. It is CPU bound and meant to run in a worker process.
+    It returns the output path, the seconds it took and the output size. A
+    tile without any visible pixel is not written, its path is None
+    """
+    begin = time.perf_counter()
+    gdal.UseExceptions()
+    mem_path = f'/vsimem/{uuid.uuid4().hex}.png'
+    gdal.FileFromMemBuffer(mem_path, content)
+    try:
+        dataset = gdal.Open(mem_path)
+        if dataset.RasterCount == 1 and dataset.GetRasterBand(1).GetColorTable() is not None:
+            # Paletted PNG, expanded to RGBA like the WMS driver does
+            dataset = gdal.Translate('', dataset, format='MEM', rgbExpand='rgba')
+        raster_data = dataset.ReadAsArray()
+        dataset = None
+    finally:
+        gdal.Unlink(mem_path)
+
+    if raster_data.ndim == 2:
+        raster_data = np.stack([raster_data] * 3)
+    bands, rows, cols = raster_data.shape
+    rgba_data = np.empty((4, rows, cols), dtype=np.uint8)
+    rgba_data[:3] = raster_data[:3]
+    if bands == 4:
+        rgba_data[3] = (raster_data[3] * transparency).astype(np.uint8)
+    else:
+        rgba_data[3] = int(255 * transparency)
+    if not rgba_data[3].any():
+        return None, time.perf_counter() - begin, 0
+
+    miny, minx, maxy, maxx = (float(value) for value in bbox.split(','))
+    driver = gdal.GetDriverByName('GTiff')
+    out_dataset = driver.Create(output_tiff, cols, rows, 4, gdal.GDT_Byte, [
+        'COMPRESS=LZW',
+        'TILED=YES',
+        'ALPHA=YES'
+    ])
+    out_dataset.SetGeoTransform((minx, (maxx - minx) / cols, 0, maxy, 0, -(maxy - miny) / rows))
+    out_dataset.SetProjection('EPSG:4326')
+    out_dataset.WriteArray(rgba_data)
+    out_dataset = None
+    return output_tiff, time.perf_counter() - begin, os.path.getsize(output_tiff)
+
+
+def reference_tile(tiff, bbox, output_vrt):
+    """This function writes a VRT that shows the pixels of tiff at bbox
+    ('miny,minx,maxy,maxx'), so that a tile identical to an already
+    encoded one is merged from the same file instead of a copy of it
+    """
+    miny, minx, maxy, maxx = (float(value) for value in bbox.split(','))
+    gdal.Translate(output_vrt, tiff, format='VRT', outputBounds=[minx, maxy, maxx, miny])
+    return output_vrt
+
+
+def download_tiles_staged(wms_url, tiles, width, height, g_token, temp_output_tiff, metrics, limiter=None,
+                          fetch_workers=FETCH_WORKERS, encode_workers=ENCODE_WORKERS, queue_size=None, progress=None,
+                          adaptive=ADAPTIVE_FETCH, bandwidth_limit=BANDWIDTH_LIMIT, hedge_budget=HEDGE_BUDGET):
+    """This function downloads the (index, bbox) tiles with a staged pipeline:
+    a pool of threads waits on the GetMap requests while a pool of processes
+    decodes, applies the alpha and encodes the tiles, so that all the cores
+    work while the network stays busy. At most queue_size tiles are between
+    the two stages at any time: when the encoders fall behind, the fetchers
+    wait. progress, if given, is called with the number of tiles completed.
+    With adaptive the requests in flight follow an AdaptiveLimit window of
+    at most fetch_workers, and bandwidth_limit caps the download rate.
+    Slow requests are hedged (see HedgePolicy) within hedge_budget.
+    Payloads are hashed when they arrive and only the first tile with a given
+    content is encoded. It returns the encoded files by index (None for the
+    empty tiles), the (bbox, index) that failed and, for each tile identical
+    to an earlier one, the index of that tile
+    """
+    queue_size = queue_size or 2 * (fetch_workers + encode_workers)
+    slots = threading.BoundedSemaphore(queue_size)
+    lock = threading.Lock()
+    output_files = {}
+    failed = []
+    completed = [0]
+    # Index of the first tile of each payload digest, and the tiles that repeat one of them
+    canonical = {}
+    duplicates = {}
+    window = AdaptiveLimit(maximum=fetch_workers) if adaptive else None
+    bucket = TokenBucket(bandwidth_limit) if bandwidth_limit else None
+    hedge = HedgePolicy(budget=hedge_budget) if hedge_budget else None
+
+    def count_done():
+        with lock:
+            completed[0] += 1
+            count = completed[0]
+        if progress is not None:
+            progress(count)
+
+    def tile_done(i, bbox, future):
+        try:
+            output_tiff, seconds, size = future.result()
+            metrics.add('encode', seconds, tile=i, bytes=size)
+            with lock:
+                output_files[i] = output_tiff
+        except Exception:
+            with lock:
+                failed.append((bbox, i))
+        finally:
+            slots.release()
+            count_done()
+
+    def fetch_hedged(i, bbox):
+        # The requests give the slots back themselves, the losing one may outlive this call
+        if window is not None:
+            window.acquire()
+        if limiter is not None:
+            limiter.acquire(wms_url)
+        with metrics.stage('fetch', tile=i) as record:
+            if window is not None:
+                record['window'] = window.window
+            content = fetch_tile_bytes_hedged(requesters, hedge, wms_url, bbox, width, height, g_token, record,
+                                              limiter, window)
+            record['bytes'] = len(content)
+        return content
+
+    def fetch(i, bbox):
+        try:
+            if hedge is not None:
+                content = fetch_hedged(i, bbox)
+            else:
+                with window.request() if window is not None else nullcontext():
+                    record = {}
+                    try:
+                        # The time spent waiting for a host slot is not part of the latency
+                        with limiter.request(wms_url) if limiter is not None else nullcontext(), \
+                                metrics.stage('fetch', tile=i) as record:
+                            content = fetch_tile_bytes(wms_url, bbox, width, height, g_token, record)
+                            record['bytes'] = len(content)
+                    finally:
+                        if window is not None and 'duration' in record:
+                            record['window'] = window.window
+                            window.on_response(record['duration'], record.get('status'), record['ok'])
+            if bucket is not None:
+                bucket.consume(len(content))
+            digest = hashlib.blake2b(content, digest_size=16).digest()
+            with lock:
+                first = canonical.setdefault(digest, i)
+                if first != i:
+                    duplicates[i] = first
+            if first != i:
+                metrics.add('duplicate', 0, tile=i, bytes=len(content))
+                slots.release()
+                count_done()
+                return
+            output_tiff = temp_output_tiff.replace('.tiff', f'_{i}_transp.tiff')
+            future = encoders.submit(encode_tile, content, bbox, width, height, output_tiff)
+        except Exception:
+            with lock:
+                failed.append((bbox, i))
+            slots.release()
+            count_done()
+            return
+        future.add_done_callback(lambda f: tile_done(i, bbox, f))
+
+    # Each fetcher has up to two requests running, the original and its duplicate. The encoders
+    # are spawned, not forked: a fork from a thread could copy a lock held by GDAL or urllib3
+    with ProcessPoolExecutor(max_workers=encode_workers, mp_context=multiprocessing.get_context('spawn')) as encoders, \
+            ThreadPoolExecutor(max_workers=2 * fetch_workers) as requesters:
+        with ThreadPoolExecutor(max_workers=fetch_workers) as fetchers:
+            for i, bbox in tiles:
+                # Backpressure: wait until a tile leaves the pipeline
+                slots.acquire()
+                fetchers.submit(fetch, i, bbox)
+    return output_files, failed, duplicates
+
+
+def fetch_tile(wms_url, bbox, width, height, g_token, output_tiff, transparency=0.5, metrics=None, tile=None, limiter=None):
+    """This function downloads the portion of the layer inside bbox with a GetMap
+    request, writes it as a GeoTIFF and sets its transparency. It returns the
+    path of the final '_transp.tiff' file and raises if the request fails
+    """
+    if metrics is None:
+        metrics = RunMetrics('')
+    options = [
+        '-co', 'ALPHA=YES',
+        '-co', 'TILED=YES',
+        '-co', 'COMPRESS=LZW'
+    ]
+
+    wms_url_with_size = f'{wms_url}?SERVICE=WMS&VERSION=1.3.0&REQUEST=GetMap&styles=default&LAYERS=0&WIDTH={width}&HEIGHT={height}\
+        &FORMAT=image/png&TRANSPARENT=true&CRS=EPSG:4326&BBOX={bbox}&token={g_token}'
+
+    # gdal.Open only reads the description of the WMS dataset, the GetMap is sent by gdal.Translate
+    # The time spent waiting for a host slot is not part of the fetch
+    with limiter.request(wms_url) if limiter is not None else nullcontext():
+        with metrics.stage('fetch', tile=tile) as record:
+            wms_dataset = gdal.Open(wms_url_with_size)
+            if wms_dataset is None:
+                raise RuntimeError('GDAL failed to open the WMS dataset')
+            gdal.Translate(output_tiff, wms_dataset, format='GTiff', width=width, height=height, options=options)
+            record['bytes'] = os.path.getsize(output_tiff)
+    wms_dataset = None
+
+    transp_tiff = output_tiff.replace('.tiff', '_transp.tiff')
+    with metrics.stage('alpha', tile=tile) as record:
+        set_transparency(output_tiff, transp_tiff, transparency=transparency)
+        record['bytes'] = os.path.getsize(transp_tiff)
+    if os.path.exists(output_tiff):
+        os.remove(output_tiff)
+    return transp_tiff
+
+
+def retry_download(bbox, i, wms_url, g_token, wh, temp_output_tiff, output_files, metrics=None, limiter=None):
+    """If some chunk requests have failed this function will 
+    try to download those parts of the file again. It returns
+    the path of the tile, or None if it failed again"""
+    begin = time.perf_counter()
+    try:
         output_file_with_idx = temp_output_tiff.replace('.tiff', f'_{i}.tiff')
-        gdal.Translate(output_file_with_idx, wms_dataset, format='GTiff', width=width, height=height, options=options)
-        
-        output_files.append(output_file_with_idx)
-
-        set_transparency(output_file_with_idx, output_file_with_idx.replace('.tiff', '_transp.tiff'), transparency=0.5)
-        output_files.remove(output_file_with_idx)
-        if os.path.exists(output_file_with_idx):
-            os.remove(output_file_with_idx)
-        output_files.append(output_file_with_idx.replace('.tiff', '_transp.tiff'))
+        transp_tiff = fetch_tile(wms_url, bbox, wh, wh, g_token, output_file_with_idx,
+                                 metrics=metrics, tile=i, limiter=limiter)
+        output_files.append(transp_tiff)
+        if metrics is not None:
+            metrics.add('retry', time.perf_counter() - begin, tile=i, retries=1, bytes=os.path.getsize(transp_tiff))
+        return transp_tiff
     except Exception as e:
+        if metrics is not None:
+            metrics.add('retry', time.perf_counter() - begin, tile=i, retries=1, ok=False)
         with open('error_log.txt', 'a') as f:
             f.write(f'{datetime.now()} - file at index {i} - BoundingBox: {bbox} - ERROR:{str(e)}')
+        return None
 
 
 class Asset:
@@ -295,57 +862,82 @@ class Asset:
         self.url = document['Url']
         self.id = document['Id']
         self.connection_info = None
-
-    def download_wms_layer(self, quadrants, quadrant_size):
+        # Set by upload_to_cesium once the layer is on Cesium and the upload has been completed
+        self.uploaded = False
+        self.metrics = RunMetrics(self.name, self.url)
+        # Resolution policy of the layer, in metres per pixel or as a maximum pixel count
+        self.target_resolution = document.get('TargetResolution')
+        self.max_pixels = document.get('MaxPixels')
+        # pixel_fingerprint of the downloaded layer, set by compute_fingerprint
+        self.fingerprint = None
+        # Optional scheduler.HostLimiter shared with the other pipelines running
+        self.limiter = None
+
+    def get_capabilities(self, quadrants, quadrant_size):
+        """Returns the capabilities of the layer with the plan of the grid
+        given by its resolution policy
+        """
+        with self.metrics.stage('capabilities'):
+            capabilities = get_capabilities(self.url, use_token=True, qs=quadrants)
+        if capabilities is None:
+            return None
+        columns, rows = grid_size(capabilities['extent'], quadrant_size, self.target_resolution,
+                                  self.max_pixels, quadrants)
+        if (columns, rows) != (quadrants, quadrants):
+            capabilities['plan'] = TilePlan.grid(capabilities['extent'], columns, rows)
+        return capabilities
+
+    def merge(self, files, capabilities, quadrant_size):
+        """Assembles the tiles of the grid of capabilities into the output of the layer"""
+        with self.metrics.stage('merge') as record:
+            plan = capabilities['plan']
+            mosaic_tiffs(files, self.name, plan.extent, plan.columns, plan.rows, quadrant_size,
+                         workspace_name=self.name)
+            record['bytes'] = os.path.getsize(os.path.join(FILES_DIR, self.name))
+
+    def compute_fingerprint(self):
+        """Fingerprints the downloaded layer, to compare it with the one on Cesium"""
+        with self.metrics.stage('fingerprint'):
+            self.fingerprint = pixel_fingerprint(os.path.join(FILES_DIR, self.name))
+        return self.fingerprint
+
+    def download_wms_layer(self, quadrants, quadrant_size, engine=WMS_ENGINE):
         """This is the main function. It will get the capabilities for the layer,
         make split requests to obtain the portions of the layer and if the process
         is successfull it will merge these files into the final tiff output
         """
+        if engine == 'gdal':
+            return self.download_wms_layer_gdal(quadrants, quadrant_size)
+        if engine == 'staged':
+            return self.download_wms_layer_staged(quadrants, quadrant_size)
+
         global step_begin
         global step_end
         global previous_line_len
 
         output_files = []
         time_diffs = []
-        failed = []
 
         try:
-            capabilities = get_capabilities(self.url, use_token=True, qs=quadrants)
+            capabilities = self.get_capabilities(quadrants, quadrant_size)
 
             width, height = quadrant_size, quadrant_size
 
             if not self.name.endswith('.tiff'):
                 self.name += '.tiff'
 
-            if f'temp_{self.name.replace('.tiff', '')}' not in os.listdir(FILES_DIR):
-                os.makedirs(os.path.join(FILES_DIR, f'temp_{self.name.replace('.tiff', '')}'))
-
-            temp_output_tiff = os.path.join(FILES_DIR, f'temp_{self.name.replace('.tiff', '')}', self.name)
+            self.check_free_space(capabilities['plan'], quadrant_size)
+            temp_output_tiff = os.path.join(workspace.create(self.name), self.name)
 
-            g_token = get_token()
-
-            for idx, bbox in enumerate(capabilities['bboxes']):
-                options = [
-                    '-co', 'ALPHA=YES',
-                    '-co', 'TILED=YES',
-                    '-co', 'COMPRESS=LZW'
-                ]
-
-                wms_url_with_size = f'{self.url}?SERVICE=WMS&VERSION=1.3.0&REQUEST=GetMap&styles=default&LAYERS=0&WIDTH={width}&HEIGHT={height}\
-                    &FORMAT=image/png&TRANSPARENT=true&CRS=EPSG:4326&BBOX={bbox}&token={g_token}'
+            with self.metrics.stage('token'):
+                g_token = get_token()
 
-                try:
-                    wms_dataset = gdal.Open(wms_url_with_size)
-                except:
-                    failed.append((bbox, i))
-                    continue
+            # Seconds per tile of the previous runs on this server, for the ETA of the first tiles
+            expected_tile_seconds = history.tile_seconds(host_of(self.url))
 
-                if wms_dataset is None:
-                    print("GDAL failed to open the WMS dataset.")
-                    sys.stdout.flush()
-                    return
-                
-                tot_quadrants = quadrants * quadrants
+            plan = capabilities['plan']
+            for idx in range(len(plan)):
+                tot_quadrants = len(plan)
                 i = idx + 1
 
                 step_begin = time.time()
@@ -353,16 +945,9 @@ class Asset:
                 if time_diffs:
                     avg_time_per_quadrant = sum(time_diffs) / len(time_diffs)
                     remaining_quadrants = tot_quadrants - i + 1
-                    eta = avg_time_per_quadrant * remaining_quadrants
-                    if eta < 60:
-                        eta_finish = datetime.now() + timedelta(seconds=eta)
-                        eta_str = f'~ {int(eta)} seconds remaining (finishes downloading at around: {eta_finish.strftime("%H:%M:%S")})'
-                    elif 60 <= eta < 3600:
-                        eta_finish = datetime.now() + timedelta(minutes=eta/60)
-                        eta_str = f'~ {round(eta/60, 2)} minutes remaining (finishes downloading at around: {eta_finish.strftime("%H:%M:%S")})'
-                    elif 3600 <= eta:
-                        eta_finish = datetime.now() + timedelta(hours=eta/3600)
-                        eta_str = f'~ {round(eta/3600, 2)} hours remaining (finishes downloading at around: {eta_finish.strftime("%H:%M:%S")})'
+                    eta_str = format_eta(avg_time_per_quadrant * remaining_quadrants)
+                elif expected_tile_seconds is not None:
+                    eta_str = format_eta(expected_tile_seconds * (tot_quadrants - i + 1))
                 else:
                     eta_str = ''
 
@@ -374,44 +959,220 @@ class Asset:
                 previous_line_len = len(f'\rDownloading {i}/{tot_quadrants}...  {eta_str}')
 
                 output_file_with_idx = temp_output_tiff.replace('.tiff', f'_{i}.tiff')
-                gdal.Translate(output_file_with_idx, wms_dataset, format='GTiff', width=width, height=height, options=options)
-                
-                output_files.append(output_file_with_idx)
-
-                set_transparency(output_file_with_idx, output_file_with_idx.replace('.tiff', '_transp.tiff'), transparency=0.5)
-                output_files.remove(output_file_with_idx)
-                if os.path.exists(output_file_with_idx):
-                    os.remove(output_file_with_idx)
-                output_files.append(output_file_with_idx.replace('.tiff', '_transp.tiff'))
+                try:
+                    output_files.append(fetch_tile(self.url, plan.bbox(idx), width, height, g_token, output_file_with_idx,
+                                                   metrics=self.metrics, tile=i, limiter=self.limiter))
+                    plan.mark(idx, DONE)
+                except Exception:
+                    plan.mark(idx, FAILED)
+                    continue
 
                 step_end = time.time()
 
                 elapsed = step_end - step_begin
                 time_diffs.append(elapsed)
 
+            failed = plan.failed()
             if failed:
                 print(f'\rRetrying failed downloads...', end='', flush=True)
-                g_token = get_token()
-                for idx, to_retry in enumerate(failed):
+                with self.metrics.stage('token'):
+                    g_token = get_token(refresh=True)
+                for n, idx in enumerate(failed):
                     print('\r' + (' ' * previous_line_len), end='', flush=True)
                     sys.stdout.flush()
-                    print(f'\rRetrying {i} {idx+1}/{len(failed)}...', end='', flush=True)
+                    print(f'\rRetrying {idx + 1} {n+1}/{len(failed)}...', end='', flush=True)
                     sys.stdout.flush()
-                    previous_line_len = len(f'\rRetrying {i} {idx}/{len(failed)}...')
-                    retry_download(to_retry[0], to_retry[1], self.url, g_token, quadrant_size, temp_output_tiff, output_files)  
+                    previous_line_len = len(f'\rRetrying {idx + 1} {n}/{len(failed)}...')
+                    if retry_download(plan.bbox(idx), idx + 1, self.url, g_token, quadrant_size, temp_output_tiff,
+                                      output_files, metrics=self.metrics, limiter=self.limiter):
+                        plan.mark(idx, DONE)
             
             print('\r' + ' ' * 150, end='\r', flush=True)
             sys.stdout.flush()
 
-            merge_tiffs(output_files, self.name)
+            self.merge(output_files, capabilities, quadrant_size)
         except Exception as e:
             print(f"Error: {str(e)}")
+            # The tiles of a failed run are not resumed, they would only fill the scratch disk
+            workspace.remove(self.name)
             print('Exiting...')
             sys.stdout.flush()
             time.sleep(2)
             sys.exit(0)
 
     
+    def temp_dir(self):
+        if not self.name.endswith('.tiff'):
+            self.name += '.tiff'
+        return workspace.create(self.name)
+
+    def check_free_space(self, plan, quadrant_size):
+        """Raises if the disks cannot hold the tiles of plan and the merged
+        layer. Without history the size is a guess and only a warning is printed"""
+        if not workspace.FREE_SPACE_CHECK:
+            return
+        size, measured = workspace.estimate_bytes(len(plan), quadrant_size, host_of(self.url))
+        workspace.check_free_space(size, size, strict=measured)
+
+    def download_preview(self, quadrants, quadrant_size, preview_quadrants=PREVIEW_QUADRANTS):
+        """Writes a low resolution version of the layer, fetched with a
+        preview_quadrants x preview_quadrants grid, where the full build goes,
+        so that it can be uploaded while the full build runs
+        """
+        capabilities = self.get_capabilities(quadrants, quadrant_size)
+        columns, rows = capabilities['plan'].columns, capabilities['plan'].rows
+        # The longer side gets preview_quadrants tiles, the other one keeps the aspect of the grid
+        scale = min(1, preview_quadrants / max(columns, rows))
+        temp_dir = self.temp_dir()
+        with self.metrics.stage('token'):
+            g_token = get_token()
+        print('Downloading a preview of the layer...', end='\r', flush=True)
+        with self.metrics.stage('preview') as record:
+            preview = fetch_level(self.url, capabilities['extent'], max(1, round(columns * scale)),
+                                  max(1, round(rows * scale)), quadrant_size, g_token,
+                                  os.path.join(temp_dir, 'preview.tiff'), self.metrics, self.limiter)
+            # The preview is on SCRATCH_DIR, which may be another file system
+            shutil.move(preview, os.path.join(FILES_DIR, self.name))
+            record['bytes'] = os.path.getsize(os.path.join(FILES_DIR, self.name))
+        print('\r' + ' ' * 150, end='\r', flush=True)
+
+    def add_wms_overviews(self, quadrants, quadrant_size):
+        """Adds to the downloaded layer the overviews of every coarser grid
+        of pyramid_levels, each one fetched directly from the WMS
+        """
+        capabilities = self.get_capabilities(quadrants, quadrant_size)
+        temp_dir = self.temp_dir()
+        with self.metrics.stage('token'):
+            g_token = get_token()
+        level_files = {}
+        for factor, columns, rows in pyramid_levels(capabilities['plan'].columns, capabilities['plan'].rows):
+            print(f'\rDownloading overview 1:{factor}...', end='', flush=True)
+            with self.metrics.stage('overview', factor=factor):
+                level_files[factor] = fetch_level(self.url, capabilities['extent'], columns, rows, quadrant_size,
+                                                  g_token, os.path.join(temp_dir, f'overview_{factor}.tiff'),
+                                                  self.metrics, self.limiter)
+        print('\r' + ' ' * 150, end='\r', flush=True)
+        if level_files:
+            with self.metrics.stage('overviews') as record:
+                write_overviews(os.path.join(FILES_DIR, self.name), level_files)
+                record['bytes'] = os.path.getsize(os.path.join(FILES_DIR, self.name))
+        for path in level_files.values():
+            os.remove(path)
+        if not os.listdir(temp_dir):
+            os.rmdir(temp_dir)
+
+    def download_wms_layer_staged(self, quadrants, quadrant_size):
+        """Same as download_wms_layer, but the tiles go through
+        download_tiles_staged instead of being fetched and encoded one by one
+        """
+        global previous_line_len
+
+        try:
+            capabilities = self.get_capabilities(quadrants, quadrant_size)
+
+            if not self.name.endswith('.tiff'):
+                self.name += '.tiff'
+
+            self.check_free_space(capabilities['plan'], quadrant_size)
+            temp_output_tiff = os.path.join(workspace.create(self.name), self.name)
+
+            with self.metrics.stage('token'):
+                g_token = get_token()
+
+            plan = capabilities['plan']
+            tiles = [(idx + 1, plan.bbox(idx)) for idx in range(len(plan))]
+            begin = time.time()
+
+            def progress(done):
+                global previous_line_len
+                eta_str = format_eta((time.time() - begin) / done * (len(tiles) - done))
+                line = f'\rDownloading {done}/{len(tiles)}...  {eta_str}'
+                print('\r' + (' ' * previous_line_len) + line, end='', flush=True)
+                previous_line_len = len(line)
+
+            output_files, failed, duplicates = download_tiles_staged(self.url, tiles, quadrant_size, quadrant_size,
+                                                                     g_token, temp_output_tiff, self.metrics,
+                                                                     limiter=self.limiter, progress=progress)
+            for i, output_tiff in output_files.items():
+                plan.mark(i - 1, DONE if output_tiff is not None else EMPTY)
+            for _, i in failed:
+                plan.mark(i - 1, FAILED)
+            for i, first in duplicates.items():
+                if first not in output_files:
+                    # The tile it repeats failed, it is fetched again with the retries
+                    plan.mark(i - 1, FAILED)
+                elif output_files[first] is None:
+                    plan.mark(i - 1, EMPTY)
+                else:
+                    output_files[i] = reference_tile(output_files[first], plan.bbox(i - 1),
+                                                     temp_output_tiff.replace('.tiff', f'_{i}_transp.vrt'))
+                    plan.mark(i - 1, DONE)
+            output_files = [output_files[i] for i in sorted(output_files) if output_files[i] is not None]
+
+            if failed:
+                print(f'\rRetrying failed downloads...', end='', flush=True)
+                with self.metrics.stage('token'):
+                    g_token = get_token(refresh=True)
+                for idx in plan.failed():
+                    if retry_download(plan.bbox(idx), idx + 1, self.url, g_token, quadrant_size, temp_output_tiff,
+                                      output_files, metrics=self.metrics, limiter=self.limiter):
+                        plan.mark(idx, DONE)
+
+            print('\r' + ' ' * 150, end='\r', flush=True)
+
+            self.merge(output_files, capabilities, quadrant_size)
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            # The tiles of a failed run are not resumed, they would only fill the scratch disk
+            workspace.remove(self.name)
+            print('Exiting...')
+            sys.stdout.flush()
+            time.sleep(2)
+            sys.exit(0)
+
+    def download_wms_layer_gdal(self, quadrants, quadrant_size, transparency=0.5):
+        """Alternative to download_wms_layer producing the same output: the whole
+        layer is described as a single GDAL WMS dataset, at the same resolution as
+        the quadrants, and written with one gdal.Translate. GDAL fetches the blocks
+        with parallel (HTTP/2 multiplexed when available) requests through its block
+        cache, there is no merge step, and the alpha band is scaled while streaming
+        """
+        try:
+            capabilities = self.get_capabilities(quadrants, quadrant_size)
+
+            if not self.name.endswith('.tiff'):
+                self.name += '.tiff'
+
+            with self.metrics.stage('token'):
+                g_token = get_token()
+
+            columns, rows = capabilities['plan'].columns, capabilities['plan'].rows
+            size_x, size_y = columns * quadrant_size, rows * quadrant_size
+            block_x = min(int(capabilities['max_width']), size_x)
+            block_y = min(int(capabilities['max_height']), size_y)
+            xml = build_wms_xml(self.url, capabilities['extent'], size_x, size_y, block_x, block_y, g_token)
+
+            gdal.SetConfigOption('GDAL_MAX_CONNECTIONS', str(GDAL_MAX_CONNECTIONS))
+            gdal.SetConfigOption('GDAL_HTTP_VERSION', '2')
+            gdal.SetConfigOption('GDAL_HTTP_MULTIPLEX', 'YES')
+
+            print('Downloading the layer with the GDAL WMS driver...', end='\r', flush=True)
+            dest = os.path.join(FILES_DIR, self.name)
+            # Band 4 is the alpha band, scaled like set_transparency does
+            scale_params = [[0, 255, 0, 255]] * 3 + [[0, 255, 0, int(255 * transparency)]]
+            with self.metrics.stage('translate') as record:
+                gdal.Translate(dest, xml, format='GTiff', scaleParams=scale_params, creationOptions=[
+                    'COMPRESS=LZW', 'TILED=YES', 'ALPHA=YES', 'BIGTIFF=IF_SAFER', 'NUM_THREADS=ALL_CPUS'
+                ])
+                record['bytes'] = os.path.getsize(dest)
+            print('\r' + ' ' * 150, end='\r', flush=True)
+        except Exception as e:
+            print(f"Error: {str(e)}")
+            print('Exiting...')
+            sys.stdout.flush()
+            time.sleep(2)
+            sys.exit(0)
+
     def create_new_asset(self):
         payload = {
             "name": self.name,
@@ -422,8 +1183,10 @@ class Asset:
             }
         }
 
-        response = requests.post(CESIUM_BASE_URL, headers=HEADERS["with_payload"], data=json.dumps(payload))
-        response_data = response.json()
+        with self.metrics.stage('create_asset') as record:
+            response = http.post(CESIUM_BASE_URL, headers=HEADERS["with_payload"], data=json.dumps(payload))
+            response_data = response.json()
+            record['ok'] = response.status_code in (200, 201)
 
         if response.status_code == 201 or response.status_code == 200:
             bucket_name = response_data['uploadLocation']['bucket']
@@ -452,19 +1215,25 @@ class Asset:
 
 
     def upload_to_cesium(self):
+        import boto3
         file_path = os.path.join(FILES_DIR, self.name)
+        with self.metrics.stage('upload') as record:
+            try:
+                session = boto3.Session(
+                    aws_access_key_id=self.connection_info['access_key'],
+                    aws_secret_access_key=self.connection_info['secret_key'],
+                    aws_session_token=self.connection_info['session_token']
+                )
+                s3 = session.client('s3')
+                with open(file_path, 'rb') as data:
+                    s3.upload_fileobj(data, self.connection_info['bucket_name'], self.connection_info['prefix'] + self.name)
+                record['bytes'] = os.path.getsize(file_path)
+            except Exception as e:
+                record['ok'] = False
+                print('err:', str(e))
+        self.uploaded = record['ok']
         try:
-            session = boto3.Session(
-                aws_access_key_id=self.connection_info['access_key'],
-                aws_secret_access_key=self.connection_info['secret_key'],
-                aws_session_token=self.connection_info['session_token']
-            )
-            s3 = session.client('s3')
-            with open(file_path, 'rb') as data:
-                s3.upload_fileobj(data, self.connection_info['bucket_name'], self.connection_info['prefix'] + self.name)
-        except Exception as e:
-            print('err:', str(e))
-        try:
-            requests.post(self.connection_info['upload_complete_url'], headers=HEADERS['no_payload'])
+            response = http.post(self.connection_info['upload_complete_url'], headers=HEADERS['no_payload'])
+            self.uploaded = self.uploaded and response.ok
         except:
-            pass
\ No newline at end of file
+            self.uploaded = False
\ No newline at end of file
@@ -0,0 +1,227 @@
+from asset import set_transparency, merge_tiffs, mosaic_tiffs, get_bboxes
+from tile_plan import TilePlan, FAILED
+from osgeo import gdal
+import numpy as np
+import statistics
+import tempfile
+import argparse
+import tracemalloc
+import subprocess
+import json
+import time
+import sys
+import os
+
+
+RASTER_SIZES = [256, 1024, 2048]
+GRID_SIZES = [16, 64, 256]
+# Grids of the TilePlan cases, the last one has 40000 tiles
+PLAN_SIZES = [16, 100, 200]
+BASELINE_FILE = 'benchmark_baseline.json'
+# A case fails when it gets slower (or bigger) than the baseline by more than this
+TOLERANCE = 0.25
+# Modules that an interactive session must not load before a regeneration starts
+HEAVY_MODULES = ['osgeo', 'numpy', 'boto3']
+
+
+def make_raster(path, size, bands, origin=(12.0, 42.0), pixel_size=0.0001):
+    """This function writes a synthetic GeoTIFF of size x size pixels with
+    the given number of bands, placed at origin with the given pixel size
+    """
+    rng = np.random.default_rng(size * bands)
+    driver = gdal.GetDriverByName('GTiff')
+    dataset = driver.Create(path, size, size, bands, gdal.GDT_Byte)
+    dataset.SetGeoTransform((origin[0], pixel_size, 0, origin[1], 0, -pixel_size))
+    dataset.SetProjection('EPSG:4326')
+    for i in range(bands):
+        band = rng.integers(0, 256, (size, size), dtype=np.uint8)
+        dataset.GetRasterBand(i + 1).WriteArray(band)
+    dataset = None
+    return path
+
+
+def make_tiles(directory, size, bands=4, n=2):
+    """This function writes an n x n grid of adjacent synthetic tiles
+    that together cover a size x size mosaic
+    """
+    tile_size = size // n
+    pixel_size = 0.0001
+    tiles = []
+    for i in range(n):
+        for j in range(n):
+            origin = (12.0 + j * tile_size * pixel_size, 42.0 - i * tile_size * pixel_size)
+            path = os.path.join(directory, f'tile_{size}_{i}_{j}.tiff')
+            tiles.append(make_raster(path, tile_size, bands, origin=origin, pixel_size=pixel_size))
+    return tiles
+
+
+def measure(func, repeat):
+    """This function runs func repeat times and returns the median wall time
+    in seconds and the peak traced memory in MB of the first run
+    """
+    timings = []
+    peak = 0
+    for run in range(repeat):
+        if run == 0:
+            tracemalloc.start()
+        begin = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - begin)
+        if run == 0:
+            peak = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+            tracemalloc.stop()
+    return statistics.median(timings), peak
+
+
+def measure_startup(module, repeat):
+    """This function imports module in a fresh interpreter repeat times and
+    returns the median wall time in seconds and the heavy modules it loaded
+    """
+    code = f'import sys, {module}; print(",".join(m for m in {HEAVY_MODULES!r} if m in sys.modules))'
+    timings = []
+    loaded = ''
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        result = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)))
+        timings.append(time.perf_counter() - begin)
+        if result.returncode != 0:
+            raise RuntimeError(f'import {module} failed: {result.stderr.strip()}')
+        loaded = result.stdout.strip()
+    return statistics.median(timings), [m for m in loaded.split(',') if m]
+
+
+def run_cases(workdir, repeat):
+    """This function builds the synthetic inputs and benchmarks every
+    raster stage on them, returning a dict of results by case name
+    """
+    results = {}
+
+    for size in RASTER_SIZES:
+        for bands in (1, 3, 4):
+            input_tiff = make_raster(os.path.join(workdir, f'in_{size}_{bands}.tiff'), size, bands)
+            output_tiff = os.path.join(workdir, f'out_{size}_{bands}.tiff')
+            name = f'set_transparency[{bands}b-{size}px]'
+            results[name] = measure(lambda: set_transparency(input_tiff, output_tiff, 0.5), repeat)
+
+        tiles = make_tiles(workdir, size)
+        # merge_tiffs joins the output name to FILES_DIR, an absolute path overrides it
+        output_tiff = os.path.join(workdir, f'merged_{size}.tiff')
+        name = f'merge_tiffs[2x2-{size}px]'
+        results[name] = measure(lambda: merge_tiffs(tiles, output_tiff, delete_temp_files=False), repeat)
+        # Same tiles, placed by block copies on the pixel lattice instead of warped
+        extent = (12.0, 42.0 - size * 0.0001, 12.0 + size * 0.0001, 42.0)
+        name = f'mosaic_tiffs[2x2-{size}px]'
+        results[name] = measure(lambda: mosaic_tiffs(tiles, output_tiff, extent, 2, 2, size // 2,
+                                                     delete_temp_files=False), repeat)
+
+    for n in GRID_SIZES:
+        name = f'get_bboxes[{n}x{n}]'
+        results[name] = measure(lambda: get_bboxes(7.0, 36.0, 19.0, 47.0, n), repeat)
+
+    def track(n):
+        # Plan, fail every seventh tile and list the failed ones, as the download loops do
+        plan = TilePlan.grid((7.0, 36.0, 19.0, 47.0), n)
+        plan.state[::7] = FAILED
+        return plan.failed()
+
+    for n in PLAN_SIZES:
+        name = f'tile_plan[{n}x{n}]'
+        results[name] = measure(lambda: track(n), repeat)
+
+    return results
+
+
+def compare_engines(url, quadrants, quadrant_size):
+    """This function downloads the same WMS layer with both download engines
+    and returns their wall time in seconds and output size in MB. It needs
+    the network and the credentials of the config
+    """
+    from asset import Asset
+    from config import FILES_DIR
+    results = {}
+    for engine in ('tiles', 'gdal'):
+        asset = Asset({'Name': f'benchmark_{engine}', 'Url': url, 'Id': None})
+        begin = time.perf_counter()
+        asset.download_wms_layer(quadrants, quadrant_size, engine=engine)
+        elapsed = time.perf_counter() - begin
+        output = os.path.join(FILES_DIR, asset.name)
+        results[f'download[{engine}]'] = (elapsed, os.path.getsize(output) / (1024 * 1024))
+        os.remove(output)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """This function compares the results with the baseline and returns
+    the list of cases that regressed over the tolerance
+    """
+    regressions = []
+    for name, (elapsed, peak) in results.items():
+        if name not in baseline:
+            continue
+        base_elapsed, base_peak = baseline[name]
+        if elapsed > base_elapsed * (1 + tolerance):
+            regressions.append(f'{name}: time {elapsed:.4f}s > baseline {base_elapsed:.4f}s')
+        if peak > base_peak * (1 + tolerance) and peak - base_peak > 1:
+            regressions.append(f'{name}: peak memory {peak:.1f}MB > baseline {base_peak:.1f}MB')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for the raster stages')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='store the results as the new baseline instead of comparing')
+    parser.add_argument('--engines', metavar='WMS_URL',
+                        help='only compare the tiles and gdal download engines on this layer')
+    parser.add_argument('--quadrants', type=int, default=4)
+    parser.add_argument('--quadrant-size', type=int, default=1024)
+    args = parser.parse_args()
+
+    gdal.UseExceptions()
+
+    if args.engines:
+        for name, (elapsed, size) in compare_engines(args.engines, args.quadrants, args.quadrant_size).items():
+            print(f'{name.ljust(36)} {elapsed:10.2f} s {size:10.2f} MB output')
+        return 0
+
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_cases(workdir, args.repeat)
+
+    startup, heavy_loaded = measure_startup('main', args.repeat)
+    results['startup[import main]'] = (startup, 0)
+
+    for name, (elapsed, peak) in results.items():
+        print(f'{name.ljust(36)} {elapsed * 1000:10.2f} ms {peak:10.2f} MB')
+
+    if heavy_loaded:
+        print(f'Importing main loads {", ".join(heavy_loaded)}, they must be imported lazily')
+        return 1
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=4)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(f'No baseline found at {args.baseline}, run with --save-baseline first')
+        return 0
+
+    with open(args.baseline, 'r') as f:
+        baseline = json.load(f)
+
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print('Regressions:')
+        for regression in regressions:
+            print(f'  {regression}')
+        return 1
+    print('No regressions')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,319 @@
+from contextlib import contextmanager
+import tempfile
+import copy
+import hashlib
+import json
+import os
+
+
+class LayerCatalog:
+    """In-memory catalog of the layers stored in the json files.
+    Layers are referenced by their position in the catalog, which is
+    stable for the whole session, and looked up through indexes on the
+    key fields (Id/Name/CesiumId) and on the fields that can be changed
+    in bulk, so edits never rely on comparing whole documents.
+    Changes are kept in memory until save(), which writes every changed
+    file once and atomically, under a lock on the file: if another program
+    saved it in the meantime, only the fields changed here are written on
+    top of its version. With journal=True each change is also
+    appended to a <file>.journal, which load() offers to replay if the
+    process died before saving: the journal is dropped if the file has
+    changed since it was started (its entries are positions in the file),
+    or if confirm_replay, called with the path and the number of changes,
+    does not accept it
+    """
+    def __init__(self, key_fields=('Id', 'Name', 'CesiumId'), multi_fields=(), journal=False, confirm_replay=None):
+        self.key_fields = tuple(key_fields)
+        self.multi_fields = tuple(multi_fields)
+        self.journal = journal
+        self.confirm_replay = confirm_replay
+        self.layers = []
+        self.sources = {}
+        self.dirty = set()
+        self._source_of = []
+        self._starts = {}
+        # sha256 of each file as it is on disk, the base of its journal
+        self._hashes = {}
+        # Fields changed since the last save, by file and by index of the layer in the file
+        self._changes = {}
+        # The layers of each file as last loaded or saved, to find the changed ones again in a newer version
+        self._originals = {}
+        self._indexes = {field: {} for field in self.key_fields + self.multi_fields}
+
+    def load(self, path):
+        """Loads the layers of a json file and indexes them"""
+        with open(path, 'rb') as f:
+            content = f.read()
+        documents = json.loads(content)
+        self.sources[path] = documents
+        self._hashes[path] = hashlib.sha256(content).hexdigest()
+        self._originals[path] = copy.deepcopy(documents)
+        self._starts[path] = len(self.layers)
+        for layer in documents:
+            position = len(self.layers)
+            self.layers.append(layer)
+            self._source_of.append(path)
+            for field, index in self._indexes.items():
+                if field in layer:
+                    index.setdefault(self._key(layer[field]), []).append(position)
+        if self.journal and os.path.exists(self._journal_path(path)):
+            self._replay(path)
+
+    def __len__(self):
+        return len(self.layers)
+
+    def __getitem__(self, position):
+        return self.layers[position]
+
+    @staticmethod
+    def _key(value):
+        # Ids are stored as int or str depending on who wrote the file
+        return str(value)
+
+    def source_of(self, position):
+        return self._source_of[position]
+
+    def find(self, field, value):
+        """Returns the positions of the layers whose field equals value"""
+        if field in self._indexes:
+            return list(self._indexes[field].get(self._key(value), []))
+        return [i for i, layer in enumerate(self.layers) if field in layer and layer[field] == value]
+
+    def lookup(self, field, value):
+        """Returns the position of the first layer whose field equals value, or None"""
+        positions = self.find(field, value)
+        return positions[0] if positions else None
+
+    def update(self, position, field, value, _journal=True):
+        """Sets field on the layer at position, keeping the indexes in sync"""
+        path = self._source_of[position]
+        if self.journal and _journal:
+            self._append_journal(path, position - self._starts[path], field, value)
+        self._changes.setdefault(path, {}).setdefault(position - self._starts[path], {})[field] = value
+        self._set(position, field, value)
+        self.dirty.add(path)
+
+    def _set(self, position, field, value):
+        layer = self.layers[position]
+        if field in self._indexes:
+            index = self._indexes[field]
+            if field in layer:
+                old_key = self._key(layer[field])
+                index[old_key].remove(position)
+                if not index[old_key]:
+                    del index[old_key]
+            index.setdefault(self._key(value), []).append(position)
+        layer[field] = value
+
+    def update_matching(self, field, old_value, new_value):
+        """Sets field to new_value on every layer where it equals old_value
+        and returns the positions that were changed
+        """
+        positions = self.find(field, old_value)
+        for position in positions:
+            self.update(position, field, new_value)
+        return positions
+
+    def select(self, selector):
+        """Returns the positions of the layers matching every field/value
+        pair of the selector, using the index of the first indexed field
+        """
+        fields = sorted(selector, key=lambda field: field not in self._indexes)
+        positions = self.find(fields[0], selector[fields[0]])
+        return [p for p in positions if all(
+            field in self.layers[p] and self._key(self.layers[p][field]) == self._key(selector[field])
+            for field in fields[1:]
+        )]
+
+    def apply_edits(self, edits, allowed_fields, optional_fields=(), parsers=None):
+        """Applies a list of {"select": {field: value, ...}, "field": ..., "value": ...}
+        edits. Selectors are resolved against the catalog before any change is
+        made and all the edits are validated first, so either every edit is
+        applied or, raising ValueError with all the problems found, none is.
+        The optional_fields can be added to layers that do not have them, and
+        the value of a field in parsers is converted by it, which raises
+        ValueError if the value is not valid.
+        Returns the (position, field) pairs whose value actually changed
+        """
+        parsers = parsers or {}
+        errors = []
+        resolved = []
+        for n, edit in enumerate(edits, start=1):
+            if not isinstance(edit, dict) or not isinstance(edit.get('select'), dict) or not edit['select']:
+                errors.append(f'edit {n}: "select" must be a non empty object')
+                continue
+            if edit.get('field') not in allowed_fields:
+                errors.append(f'edit {n}: field {edit.get("field")!r} is not one of {", ".join(allowed_fields)}')
+                continue
+            if 'value' not in edit:
+                errors.append(f'edit {n}: "value" is missing')
+                continue
+            value = edit['value']
+            if edit['field'] in parsers:
+                try:
+                    value = parsers[edit['field']](value)
+                except ValueError as e:
+                    errors.append(f'edit {n}: {str(e)}')
+                    continue
+            positions = self.select(edit['select'])
+            if not positions:
+                errors.append(f'edit {n}: no layer matches {edit["select"]}')
+                continue
+            missing = [self.layers[p].get('Name', p) for p in positions if edit['field'] not in self.layers[p]]
+            if missing and edit['field'] not in optional_fields:
+                errors.append(f'edit {n}: field {edit["field"]} does not exist in {", ".join(map(str, missing))}')
+                continue
+            resolved.append((positions, edit['field'], value))
+        if errors:
+            raise ValueError('\n'.join(errors))
+
+        changed = []
+        for positions, field, value in resolved:
+            for position in positions:
+                if field not in self.layers[position] or self.layers[position][field] != value:
+                    self.update(position, field, value)
+                    changed.append((position, field))
+        return changed
+
+    def save(self):
+        """Writes back the json files that have been changed, each one
+        through a temp file that atomically replaces the original
+        """
+        for path in sorted(self.dirty):
+            with file_lock(path):
+                documents = self.sources[path]
+                if file_sha256(path) != self._hashes[path]:
+                    documents = self._merge_saved(path)
+                write_json_atomic(path, documents)
+                # If the layers of the file no longer match the catalog, the next save has to merge again
+                self._hashes[path] = file_sha256(path) if documents is self.sources[path] else None
+            if os.path.exists(self._journal_path(path)):
+                os.remove(self._journal_path(path))
+            self._changes.pop(path, None)
+            self._originals[path] = copy.deepcopy(self.sources[path])
+        self.dirty.clear()
+
+    def _merge_saved(self, path):
+        """Returns the layers of path as another program saved them, with the
+        fields changed in this catalog written on top. The changed layers are
+        found again by their key fields, since layers may have been added or
+        removed; the ones that no longer exist are left out. If the file still
+        has the same layers in the same order the catalog takes its values
+        """
+        with open(path, 'r', encoding='utf-8') as f:
+            documents = json.load(f)
+        changes = self._changes.get(path, {})
+        same_layers = len(documents) == len(self.sources[path])
+        for index, fields in changes.items():
+            match = self._resolve(self._originals[path][index], documents)
+            same_layers = same_layers and match == index
+            if match is not None:
+                documents[match].update(fields)
+        if not same_layers:
+            return documents
+        for index, document in enumerate(documents):
+            for field, value in document.items():
+                position = self._starts[path] + index
+                if self.layers[position].get(field) != value:
+                    self._set(position, field, value)
+        return self.sources[path]
+
+    def _resolve(self, layer, documents):
+        """Returns the index of layer in documents, from the first key field
+        whose value is found on exactly one of them, or None"""
+        for field in self.key_fields:
+            if field not in layer:
+                continue
+            matches = [i for i, document in enumerate(documents)
+                       if field in document and self._key(document[field]) == self._key(layer[field])]
+            if len(matches) == 1:
+                return matches[0]
+        return None
+
+    @staticmethod
+    def _journal_path(path):
+        return path + '.journal'
+
+    def _append_journal(self, path, index, field, value):
+        entry = json.dumps({'i': index, 'f': field, 'v': value}, separators=(',', ':'))
+        header = not os.path.exists(self._journal_path(path))
+        with open(self._journal_path(path), 'a', encoding='utf-8') as f:
+            if header:
+                f.write(json.dumps({'base': self._hashes[path]}) + '\n')
+            f.write(entry + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def _replay(self, path):
+        """Applies the changes journaled for path that were never saved, if
+        the journal was started on the file as it is now and the replay is
+        confirmed. Otherwise the journal is deleted
+        """
+        entries = []
+        with open(self._journal_path(path), 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # A torn last line from a crash mid-append
+                    break
+        if not entries or entries[0].get('base') != self._hashes[path]:
+            entries = []
+        entries = entries[1:]
+        if entries and self.confirm_replay is not None and self.confirm_replay(path, len(entries)):
+            for entry in entries:
+                self.update(self._starts[path] + entry['i'], entry['f'], entry['v'], _journal=False)
+        else:
+            os.remove(self._journal_path(path))
+
+
+@contextmanager
+def file_lock(path):
+    """Holds an exclusive lock on path + '.lock', shared with the other
+    processes saving path, while the block runs"""
+    with open(path + '.lock', 'a+') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            while True:
+                try:
+                    # LK_LOCK gives up after 10 seconds
+                    msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        else:
+            import fcntl
+            fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def file_sha256(path):
+    with open(path, 'rb') as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def write_json_atomic(path, content):
+    """Writes content as json to a temp file next to path and renames it
+    over path, so readers see either the old or the new file, never a
+    partially written one
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix='.' + os.path.basename(path), suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(content, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
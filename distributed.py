@@ -0,0 +1,204 @@
+from datetime import datetime
+from worker import load_catalog, find_layer
+from tile_plan import DONE, FAILED
+from config import *
+import argparse
+import socket
+import sqlite3
+import config
+import time
+import sys
+import os
+
+
+TILES_DB = getattr(config, 'TILES_DB', 'tiles.sqlite')
+# Directory shared by the coordinator and the workers where the tiles are written
+SHARED_DIR = getattr(config, 'SHARED_DIR', FILES_DIR)
+# A tile claimed for longer than this is given to another worker
+LEASE_SECONDS = 600
+MAX_ATTEMPTS = 3
+POLL_INTERVAL = 5
+
+
+def connect(path=TILES_DB):
+    """This function opens the shared tile queue, creating the tables the first time"""
+    connection = sqlite3.connect(path, timeout=60, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS layers (
+            name TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            quadrant_size INTEGER NOT NULL,
+            tiles_dir TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'open',
+            created TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tiles (
+            layer TEXT NOT NULL,
+            idx INTEGER NOT NULL,
+            bbox TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            worker TEXT,
+            claimed_at REAL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            path TEXT,
+            error TEXT,
+            PRIMARY KEY (layer, idx)
+        );
+    ''')
+    return connection
+
+
+def publish(connection, name, url, bboxes, quadrant_size, tiles_dir):
+    """This function replaces the plan of a layer with one pending tile per bbox"""
+    connection.execute('BEGIN IMMEDIATE')
+    connection.execute('DELETE FROM tiles WHERE layer = ?', (name,))
+    connection.execute(
+        'INSERT OR REPLACE INTO layers (name, url, quadrant_size, tiles_dir, status, created) VALUES (?, ?, ?, ?, ?, ?)',
+        (name, url, quadrant_size, tiles_dir, 'open', datetime.now().isoformat())
+    )
+    connection.executemany(
+        'INSERT INTO tiles (layer, idx, bbox) VALUES (?, ?, ?)',
+        [(name, idx + 1, bbox) for idx, bbox in enumerate(bboxes)]
+    )
+    connection.execute('COMMIT')
+
+
+def claim_tile(connection, worker_id):
+    """This function gives a pending tile, or one whose lease expired, to the worker"""
+    connection.execute('BEGIN IMMEDIATE')
+    try:
+        row = connection.execute('''
+            SELECT tiles.layer, tiles.idx, tiles.bbox, layers.url, layers.quadrant_size, layers.tiles_dir
+            FROM tiles JOIN layers ON layers.name = tiles.layer
+            WHERE layers.status = 'open'
+              AND (tiles.status = 'pending' OR (tiles.status = 'claimed' AND tiles.claimed_at < ?))
+            ORDER BY layers.created, tiles.idx LIMIT 1
+        ''', (time.time() - LEASE_SECONDS,)).fetchone()
+        if row is not None:
+            connection.execute(
+                "UPDATE tiles SET status = 'claimed', worker = ?, claimed_at = ?, attempts = attempts + 1 "
+                "WHERE layer = ? AND idx = ?",
+                (worker_id, time.time(), row['layer'], row['idx'])
+            )
+        connection.execute('COMMIT')
+    except BaseException:
+        connection.execute('ROLLBACK')
+        raise
+    return row
+
+
+def complete_tile(connection, layer, idx, path):
+    connection.execute(
+        "UPDATE tiles SET status = 'done', path = ?, error = NULL WHERE layer = ? AND idx = ?", (path, layer, idx)
+    )
+
+
+def fail_tile(connection, layer, idx, error):
+    """This function puts the tile back in the queue, or marks it as failed
+    once it has been tried MAX_ATTEMPTS times"""
+    connection.execute(
+        "UPDATE tiles SET status = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, error = ? "
+        "WHERE layer = ? AND idx = ?",
+        (MAX_ATTEMPTS, error, layer, idx)
+    )
+
+
+def work(path=TILES_DB, worker_id=None, poll_interval=POLL_INTERVAL):
+    """This function fetches and encodes the tiles of the shared queue, forever"""
+    from asset import fetch_tile, get_token
+    worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+    connection = connect(path)
+    print(f'Worker {worker_id} waiting for tiles in {path}')
+    while True:
+        tile = claim_tile(connection, worker_id)
+        if tile is None:
+            time.sleep(poll_interval)
+            continue
+        output_tiff = os.path.join(tile['tiles_dir'], f'{tile["layer"]}_{tile["idx"]}.tiff')
+        try:
+            transp_tiff = fetch_tile(tile['url'], tile['bbox'], tile['quadrant_size'], tile['quadrant_size'],
+                                     get_token(), output_tiff)
+        except Exception as e:
+            fail_tile(connection, tile['layer'], tile['idx'], str(e))
+            print(f'{tile["layer"]} tile {tile["idx"]}: {str(e)}')
+            continue
+        complete_tile(connection, tile['layer'], tile['idx'], transp_tiff)
+        print(f'{tile["layer"]} tile {tile["idx"]} done')
+
+
+def distributed_download(asset, path=TILES_DB, shared_dir=SHARED_DIR, quadrants=N_QUADRANTS,
+                         quadrant_size=QUADRANT_SIZE, poll_interval=POLL_INTERVAL):
+    """This function publishes the bbox plan of the asset to the shared queue,
+    waits for the workers to fetch every tile and merges them into the final tiff"""
+    capabilities = asset.get_capabilities(quadrants, quadrant_size)
+    if not asset.name.endswith('.tiff'):
+        asset.name += '.tiff'
+    layer = asset.name.replace('.tiff', '')
+    tiles_dir = os.path.join(shared_dir, f'temp_{layer}')
+    os.makedirs(tiles_dir, exist_ok=True)
+
+    connection = connect(path)
+    plan = capabilities['plan']
+    publish(connection, layer, asset.url, plan.bboxes(), quadrant_size, tiles_dir)
+    total = len(plan)
+    while True:
+        counts = dict(connection.execute(
+            'SELECT status, COUNT(*) FROM tiles WHERE layer = ? GROUP BY status', (layer,)
+        ).fetchall())
+        done, failed = counts.get('done', 0), counts.get('failed', 0)
+        print(f'\rDownloading {done}/{total}... ({failed} failed)', end='', flush=True)
+        if done + failed == total:
+            break
+        time.sleep(poll_interval)
+    print('\r' + ' ' * 150, end='\r', flush=True)
+
+    # The outcome of each tile, from the queue, on the plan of the layer
+    for row in connection.execute("SELECT idx, status FROM tiles WHERE layer = ?", (layer,)):
+        plan.mark(row['idx'] - 1, DONE if row['status'] == 'done' else FAILED)
+    if failed:
+        for row in connection.execute("SELECT idx, bbox, error FROM tiles WHERE layer = ? AND status = 'failed'", (layer,)):
+            with open('error_log.txt', 'a') as f:
+                f.write(f'{datetime.now()} - file at index {row["idx"]} - BoundingBox: {row["bbox"]} - ERROR:{row["error"]}')
+    files = [row['path'] for row in connection.execute(
+        "SELECT path FROM tiles WHERE layer = ? AND status = 'done' ORDER BY idx", (layer,)
+    )]
+    connection.execute("UPDATE layers SET status = 'closed' WHERE name = ?", (layer,))
+    connection.close()
+
+    asset.merge(files, capabilities, quadrant_size)
+    if os.path.isdir(tiles_dir) and not os.listdir(tiles_dir):
+        os.rmdir(tiles_dir)
+
+
+def coordinate(layer_name, path=TILES_DB, shared_dir=SHARED_DIR):
+    """This function regenerates a layer letting the workers fetch its tiles,
+    then uploads the mosaic and swaps the Cesium asset as main.py does"""
+    from main import regenerate_layer
+    catalog = load_catalog()
+    position = find_layer(catalog, layer_name)
+    regenerate_layer(catalog, position, download=lambda asset: distributed_download(asset, path, shared_dir))
+    catalog.save()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tile fetching spread over several machines')
+    parser.add_argument('--db', default=TILES_DB, help='tile queue, on a mount shared by all the machines')
+    commands = parser.add_subparsers(dest='command', required=True)
+    coordinate_parser = commands.add_parser('coordinate', help='publish a layer, wait for its tiles, merge and upload')
+    coordinate_parser.add_argument('layer', help='name of the layer in ASSETS_JSON')
+    coordinate_parser.add_argument('--shared-dir', default=SHARED_DIR)
+    work_parser = commands.add_parser('work', help='fetch the tiles of the published layers')
+    work_parser.add_argument('--id', help='name of this worker (default host-pid)')
+    work_parser.add_argument('--poll', type=float, default=POLL_INTERVAL)
+    args = parser.parse_args()
+
+    if args.command == 'coordinate':
+        coordinate(args.layer, args.db, args.shared_dir)
+    elif args.command == 'work':
+        work(args.db, args.id, args.poll)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
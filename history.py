@@ -0,0 +1,231 @@
+from scheduler import host_of
+from datetime import datetime
+import statistics
+import argparse
+import sqlite3
+import config
+import sys
+
+
+HISTORY_DB = getattr(config, 'HISTORY_DB', 'history.sqlite')
+# Stages of the per-tile records that encode the tile, after it has been fetched
+ENCODE_STAGES = ('alpha', 'encode')
+
+
+def connect(path=HISTORY_DB):
+    """This function opens the history database, creating the tables the first time"""
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.executescript('''
+        CREATE TABLE IF NOT EXISTS runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            layer TEXT NOT NULL,
+            url TEXT,
+            host TEXT,
+            started TEXT NOT NULL,
+            finished TEXT NOT NULL,
+            duration REAL NOT NULL,
+            download_seconds REAL NOT NULL,
+            tiles INTEGER NOT NULL,
+            failed_tiles INTEGER NOT NULL,
+            retries INTEGER NOT NULL,
+            download_bytes INTEGER NOT NULL,
+            output_bytes INTEGER,
+            upload_bytes INTEGER,
+            upload_seconds REAL,
+            ok INTEGER NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tiles (
+            run_id INTEGER NOT NULL REFERENCES runs(id),
+            tile TEXT NOT NULL,
+            fetch_seconds REAL NOT NULL,
+            encode_seconds REAL NOT NULL,
+            bytes INTEGER NOT NULL,
+            status INTEGER,
+            retries INTEGER NOT NULL,
+            ok INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS runs_host ON runs (host, started);
+        CREATE INDEX IF NOT EXISTS runs_layer ON runs (layer, started);
+    ''')
+    return connection
+
+
+def tile_rows(records):
+    """This function groups the per-tile records of a run by tile. Only the
+    tiles of the layer count, the ones of the preview and of the overview
+    levels of fetch_level are named 'columnsxrows:i' and are skipped"""
+    tiles = {}
+    for record in records:
+        if not isinstance(record.get('tile'), int):
+            continue
+        tile = tiles.setdefault(str(record['tile']), {
+            'fetch_seconds': 0.0, 'encode_seconds': 0.0, 'bytes': 0, 'status': None, 'retries': 0, 'ok': True
+        })
+        if record['stage'] == 'fetch':
+            tile['fetch_seconds'] += record['duration']
+            tile['bytes'] = tile['bytes'] or record['bytes']
+            tile['status'] = record.get('status', tile['status'])
+            tile['ok'] = record['ok']
+        elif record['stage'] in ENCODE_STAGES:
+            tile['encode_seconds'] += record['duration']
+        elif record['stage'] == 'retry':
+            tile['fetch_seconds'] += record['duration']
+            tile['retries'] += 1
+            tile['ok'] = record['ok']
+        elif record['stage'] == 'duplicate':
+            tile['bytes'] = record['bytes']
+    return tiles
+
+
+def record_run(metrics, path=HISTORY_DB):
+    """This function stores a finished run, from its RunMetrics, with one
+    row for the layer and one for each of its tiles. It returns the run id
+    """
+    finished = datetime.now()
+    summary = metrics.summary()
+    tiles = tile_rows(metrics.records)
+    duration = (finished - metrics.started).total_seconds()
+    # Only the download is proportional to the tiles, creating and uploading the asset are not
+    download_seconds = duration - sum(summary.get(stage, {}).get('duration', 0) for stage in ('create_asset', 'upload', 'swap'))
+    upload = summary.get('upload')
+    connection = connect(path)
+    connection.execute('BEGIN')
+    cursor = connection.execute(
+        'INSERT INTO runs (layer, url, host, started, finished, duration, download_seconds, tiles, failed_tiles, '
+        'retries, download_bytes, output_bytes, upload_bytes, upload_seconds, ok) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+        (metrics.layer_name, metrics.url, host_of(metrics.url or ''), metrics.started.isoformat(),
+         finished.isoformat(), duration, max(download_seconds, 0), len(tiles),
+         sum(1 for tile in tiles.values() if not tile['ok']), sum(tile['retries'] for tile in tiles.values()),
+         sum(tile['bytes'] for tile in tiles.values()), summary.get('merge', {}).get('bytes'),
+         upload['bytes'] if upload else None, upload['duration'] if upload else None,
+         int(all(values['failed'] == 0 for stage, values in summary.items() if stage not in ('fetch', 'retry'))))
+    )
+    run_id = cursor.lastrowid
+    connection.executemany(
+        'INSERT INTO tiles (run_id, tile, fetch_seconds, encode_seconds, bytes, status, retries, ok) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+        [(run_id, name, tile['fetch_seconds'], tile['encode_seconds'], tile['bytes'], tile['status'],
+          tile['retries'], int(tile['ok'])) for name, tile in tiles.items()]
+    )
+    connection.execute('COMMIT')
+    connection.close()
+    return run_id
+
+
+def load_runs(path=HISTORY_DB, limit=200):
+    """This function returns the per-tile figures of the last runs that
+    downloaded tiles, in the form used by planner.estimate
+    """
+    connection = connect(path)
+    rows = connection.execute(
+        'SELECT * FROM runs WHERE tiles > 0 AND output_bytes IS NOT NULL ORDER BY id DESC LIMIT ?', (limit,)
+    ).fetchall()
+    connection.close()
+    return [{
+        'host': row['host'],
+        'tile_seconds': row['download_seconds'] / row['tiles'],
+        'tile_bytes': row['download_bytes'] / row['tiles'],
+        'output_tile_bytes': row['output_bytes'] / row['tiles'],
+        'upload_rate': row['upload_bytes'] / row['upload_seconds'] if row['upload_bytes'] and row['upload_seconds'] else None
+    } for row in rows]
+
+
+def tile_seconds(host, path=HISTORY_DB, runs=5):
+    """This function returns the median wall seconds per tile of the last
+    runs on host, or None if the host has never been downloaded from
+    """
+    connection = connect(path)
+    rows = connection.execute(
+        'SELECT download_seconds, tiles FROM runs WHERE host = ? AND tiles > 0 ORDER BY id DESC LIMIT ?', (host, runs)
+    ).fetchall()
+    connection.close()
+    return statistics.median(row['download_seconds'] / row['tiles'] for row in rows) if rows else None
+
+
+def expected_duration(layer, path=HISTORY_DB, runs=5):
+    """This function returns the median duration of the last runs of a
+    layer, or None if it has never been regenerated
+    """
+    connection = connect(path)
+    rows = connection.execute(
+        'SELECT duration FROM runs WHERE layer IN (?, ?) ORDER BY id DESC LIMIT ?',
+        (layer, f'{layer}.tiff', runs)
+    ).fetchall()
+    connection.close()
+    return statistics.median(row['duration'] for row in rows) if rows else None
+
+
+def print_runs(layer=None, host=None, limit=20, path=HISTORY_DB):
+    connection = connect(path)
+    query, params = 'SELECT * FROM runs WHERE 1 = 1', []
+    if layer:
+        query += ' AND layer IN (?, ?)'
+        params += [layer, f'{layer}.tiff']
+    if host:
+        query += ' AND host = ?'
+        params.append(host)
+    rows = connection.execute(query + ' ORDER BY id DESC LIMIT ?', params + [limit]).fetchall()
+    connection.close()
+    for row in rows:
+        print(f'{str(row["id"]).ljust(5)} {row["started"][:19]}  {"ok    " if row["ok"] else "failed"} {row["layer"]}')
+        print(f'      {row["tiles"]} tiles ({row["failed_tiles"]} failed, {row["retries"]} retries) in '
+              f'{row["duration"]:.0f}s, {row["download_bytes"] / 1e6:.1f} MB downloaded, '
+              f'{(row["output_bytes"] or 0) / 1e6:.1f} MB output, upload {row["upload_seconds"] or 0:.0f}s')
+    return rows
+
+
+def print_tiles(run_id, path=HISTORY_DB):
+    connection = connect(path)
+    rows = connection.execute('SELECT * FROM tiles WHERE run_id = ? ORDER BY rowid', (run_id,)).fetchall()
+    connection.close()
+    for row in rows:
+        print(f'{row["tile"].ljust(12)} fetch {row["fetch_seconds"]:8.2f}s  encode {row["encode_seconds"]:6.2f}s  '
+              f'{row["bytes"] / 1e3:9.1f} KB  status {row["status"] or "-"}  retries {row["retries"]}  '
+              f'{"ok" if row["ok"] else "failed"}')
+    return rows
+
+
+def print_hosts(path=HISTORY_DB):
+    """This function prints, for each host, the seconds per tile of its runs
+    month by month, so that servers getting slower stand out
+    """
+    connection = connect(path)
+    rows = connection.execute('''
+        SELECT host, substr(started, 1, 7) AS month, COUNT(*) AS runs,
+               SUM(download_seconds) / SUM(tiles) AS tile_seconds,
+               SUM(failed_tiles) * 1.0 / SUM(tiles) AS failure_rate
+        FROM runs WHERE tiles > 0 GROUP BY host, month ORDER BY host, month
+    ''').fetchall()
+    connection.close()
+    for row in rows:
+        print(f'{(row["host"] or "-").ljust(40)} {row["month"]}  {str(row["runs"]).rjust(4)} runs  '
+              f'{row["tile_seconds"]:7.2f} s/tile  {row["failure_rate"] * 100:5.1f}% failed')
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Timings, sizes and failures of the past regenerations')
+    parser.add_argument('--db', default=HISTORY_DB)
+    commands = parser.add_subparsers(dest='command', required=True)
+    runs_parser = commands.add_parser('runs', help='list the last runs')
+    runs_parser.add_argument('--layer')
+    runs_parser.add_argument('--host')
+    runs_parser.add_argument('--limit', type=int, default=20)
+    tiles_parser = commands.add_parser('tiles', help='show the tiles of a run')
+    tiles_parser.add_argument('run', type=int)
+    commands.add_parser('hosts', help='seconds per tile of each host, month by month')
+    args = parser.parse_args()
+
+    if args.command == 'runs':
+        print_runs(args.layer, args.host, args.limit, args.db)
+    elif args.command == 'tiles':
+        print_tiles(args.run, args.db)
+    elif args.command == 'hosts':
+        print_hosts(args.db)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
@@ -1,6 +1,11 @@
 from utils import  delete_local_layer, clear_previous_lines, delete_cesium_asset
-from asset import Asset
+from catalog import LayerCatalog
+from history import record_run
+from workspace import collect_garbage
+from functools import partial
 from config import *
+import argparse
+import math
 import json
 import time
 import sys
@@ -8,17 +13,164 @@ import warnings
 
 warnings.filterwarnings("ignore")
 
-CHANGEABLE_FIELDS = ['Name', 'Url', 'ParentUrl']
+CHANGEABLE_FIELDS = ['Name', 'Url', 'ParentUrl', 'TargetResolution', 'MaxPixels']
+# Fields of the ASSETS_JSON layers whose change requires a regeneration
+REGENERATE_FIELDS = ['Url', 'TargetResolution', 'MaxPixels']
+# Resolution policy of the ASSETS_JSON layers, which can be added to the layers that have none
+POLICY_FIELDS = ['TargetResolution', 'MaxPixels']
+
+
+def parse_policy(field, value):
+    """This function converts a TargetResolution (metres per pixel) or MaxPixels
+    value, as typed or read from a json file, to a positive number. An empty
+    value removes the policy. It raises ValueError if the value is not valid
+    """
+    if value is None or str(value).strip() == '':
+        return None
+    try:
+        number = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{field} must be a number, not {value!r}')
+    if not math.isfinite(number) or number <= 0 or (field == 'MaxPixels' and number < 1):
+        raise ValueError(f'{field} must be a positive number, not {value!r}')
+    return int(number) if field == 'MaxPixels' else number
+
+
+def bulk_edit(edits_path):
+    """This function applies without any prompt the edits listed in a json file,
+    e.g. [{"select": {"ParentUrl": "old"}, "field": "ParentUrl", "value": "new"}],
+    loading and saving the json documents only once. It returns the layers
+    whose Url or resolution policy changed, which have to be regenerated
+    """
+    catalog = LayerCatalog(key_fields=('Id', 'Name'), multi_fields=('ParentUrl',), journal=True)
+    try:
+        with open(edits_path, 'r', encoding='utf-8') as f:
+            edits = json.load(f)
+    except Exception as e:
+        print(f'Error opening {edits_path}: {str(e)}')
+        return None
+    for path in (ARCGIS_JSON, ASSETS_JSON):
+        try:
+            catalog.load(path)
+        except Exception as e:
+            print(f'Error opening {path}: {str(e)}')
+            return None
+    try:
+        changed = catalog.apply_edits(edits, CHANGEABLE_FIELDS, optional_fields=POLICY_FIELDS,
+                                      parsers={field: partial(parse_policy, field) for field in POLICY_FIELDS})
+    except ValueError as e:
+        print('No change applied, invalid edits:')
+        print(str(e))
+        return None
+    catalog.save()
+    print(f'{len(changed)} fields updated')
+    to_regenerate = sorted({
+        position for position, field in changed
+        if field in REGENERATE_FIELDS and catalog.source_of(position) == ASSETS_JSON
+    })
+    if to_regenerate:
+        print('Layers to regenerate:')
+        for position in to_regenerate:
+            print(f'  {catalog[position]['Name']}')
+    return [catalog[position] for position in to_regenerate]
+
+
+def confirm_replay(path, changes):
+    """This function asks whether the changes to path left unsaved by a
+    previous session have to be applied, see LayerCatalog"""
+    while True:
+        answer = input(f'{changes} unsaved changes to {path} from a previous session. Apply them? [y/n]\n')
+        clear_previous_lines(n=2)
+        if answer.lower() in ('y', 'n'):
+            return answer.lower() == 'y'
+
+
+def upload_layer(asset):
+    """This function creates the new asset on Cesium and uploads the layer to
+    it. It raises if either fails, before anything is done to the old asset"""
+    # With PREVIEW_FIRST the asset has already been uploaded once, as the preview
+    asset.connection_info = None
+    asset.uploaded = False
+    asset.create_new_asset()
+    if asset.connection_info is None:
+        raise RuntimeError(f'Could not create the new asset of {asset.name} on Cesium')
+    asset.upload_to_cesium()
+    if not asset.uploaded:
+        raise RuntimeError(f'Could not upload {asset.name} to Cesium, the old asset is kept')
+
+
+def regenerate_layer(catalog, position, limiter=None, download=None, persist=None):
+    """This function downloads again the layer at the given position of the catalog
+    from its Url, uploads it to Cesium as a new asset, deletes the old asset and
+    stores the new Id in the catalog. The limiter, if given, is shared with the
+    other pipelines running at the same time. download, if given, is called with
+    the asset instead of asset.download_wms_layer to produce the merged tiff.
+    If the pixels are the same as the ones of the asset on Cesium (same
+    Fingerprint) the asset is kept and nothing is uploaded. With PREVIEW_FIRST
+    the old asset is deleted before the full build, so the preview swap is
+    stored right away: persist, if given, is called with the changed fields,
+    otherwise the catalog is saved
+    """
+    # GDAL, numpy and boto3 are only loaded when a regeneration starts
+    from asset import Asset, PREVIEW_FIRST, WMS_OVERVIEWS
+    found_layer = catalog[position]
+    asset = Asset(found_layer)
+    asset.limiter = limiter
+    try:
+        if PREVIEW_FIRST:
+            # The low resolution preview replaces the old asset now, the full build replaces the preview later
+            print('Uploading a preview of the layer to Cesium...')
+            asset.download_preview(N_QUADRANTS, QUADRANT_SIZE)
+            upload_layer(asset)
+            with asset.metrics.stage('swap'):
+                delete_cesium_asset(found_layer['Id'])
+                delete_local_layer(asset.name)
+                # The fingerprint of the old asset must not match the full build
+                swap = {'Id': int(asset.id), 'Fingerprint': None}
+                for field, value in swap.items():
+                    catalog.update(position, field, value)
+                if persist is None:
+                    catalog.save()
+                else:
+                    persist(swap)
+            clear_previous_lines(n=1)
+        print('Downloading layer from updated Url...')
+        if download is None:
+            asset.download_wms_layer(quadrants=N_QUADRANTS, quadrant_size=QUADRANT_SIZE)
+        else:
+            download(asset)
+        if WMS_OVERVIEWS:
+            asset.add_wms_overviews(N_QUADRANTS, QUADRANT_SIZE)
+        # With PREVIEW_FIRST the asset on Cesium is the preview, the full build is always uploaded
+        if asset.compute_fingerprint() == found_layer.get('Fingerprint') and not PREVIEW_FIRST:
+            clear_previous_lines(n=1)
+            print('The layer has not changed, the asset on Cesium is kept')
+            delete_local_layer(asset.name)
+            return asset
+        clear_previous_lines(n=2)
+        print('Uploading downloaded layer to Cesium...')
+        upload_layer(asset)
+        clear_previous_lines(n=1)
+        with asset.metrics.stage('swap'):
+            delete_cesium_asset(found_layer['Id'])
+            delete_local_layer(asset.name)
+            catalog.update(position, 'Id', int(asset.id))
+            catalog.update(position, 'Fingerprint', asset.fingerprint)
+    finally:
+        # Failed runs are recorded too, the download code exits the process on errors
+        asset.metrics.write()
+        record_run(asset.metrics)
+    return asset
+
 
 def main():
+    catalog = LayerCatalog(key_fields=('Id', 'Name'), journal=True, confirm_replay=confirm_replay)
     try:
-        with open(ARCGIS_JSON, 'r', encoding='utf-8') as f:
-            arcgis_layers_json = json.load(f)
+        catalog.load(ARCGIS_JSON)
     except Exception as e:
         print(f'Error opening {ARCGIS_JSON}: {str(e)}')
     try:
-        with open(ASSETS_JSON, 'r', encoding='utf-8') as f:
-            cesium_layers_json = json.load(f)
+        catalog.load(ASSETS_JSON)
     except Exception as e:
         print(f'Error opening {ASSETS_JSON}: {str(e)}')
     while True:
@@ -34,7 +186,7 @@ def main():
             return
         else:
             clear_previous_lines(n=2)
-    layers = arcgis_layers_json + cesium_layers_json
+    layers = catalog.layers
     for index, layer in enumerate(layers):
         str_index = str(index + 1).ljust(2)
         print(f'{str_index}: {layer['Name']}')
@@ -59,16 +211,22 @@ def main():
             continue
     found_layer = layers[chosen]
     layer_to_print = {k:v for k, v in found_layer.items() if k in CHANGEABLE_FIELDS}
+    if catalog.source_of(chosen) == ASSETS_JSON:
+        # The resolution policy can be set on the layers that do not have one yet
+        for field in POLICY_FIELDS:
+            layer_to_print.setdefault(field, None)
     dict_lines = 2
     print('You selected:\n{')
     for k, v in layer_to_print.items():
-        if isinstance(v, int):
+        if v is None:
+            print(f'"{k}": null')
+        elif isinstance(v, (int, float)):
             print(f'"{k}": {v}')
         else:
             print(f'"{k}": "{v}"')
         dict_lines += 1
     print('}')
-    modifiable_items = [k for k in found_layer.keys() if k in CHANGEABLE_FIELDS]
+    modifiable_items = list(layer_to_print.keys())
     for i, k in enumerate(modifiable_items):
             print(f'{i + 1}: {k}')
     while True:
@@ -90,10 +248,18 @@ def main():
         except:
             clear_previous_lines(n=2)
             chosen = input('Please select a valid index:\n')
-    print(f'Old {selected_key}: {found_layer[selected_key]}')
+    print(f'Old {selected_key}: {found_layer.get(selected_key)}')
     print(f'Write the new {selected_key}:')
     while True:
         new_value = input()
+        if selected_key in POLICY_FIELDS:
+            try:
+                new_value = parse_policy(selected_key, new_value)
+            except ValueError as e:
+                print(str(e))
+                time.sleep(2)
+                clear_previous_lines(n=2)
+                continue
         print('Do you want to proceed and update? [y/n] To exit enter 0')
         proceed = input()
         if proceed == '0':
@@ -107,40 +273,47 @@ def main():
             clear_previous_lines(n=3)
         else:
             clear_previous_lines(n=3)
-    print(f'Updating {selected_key} as {new_value}')
-    for layer in arcgis_layers_json:
-        if found_layer == layer:
-            layer[selected_key] = new_value
-            with open(ARCGIS_JSON, 'w') as f:
-                json.dump(arcgis_layers_json, f, indent=4)
-            print('Json document updated')
+    if selected_key in REGENERATE_FIELDS and catalog.source_of(chosen) == ASSETS_JSON:
+        # Dry run on the edited layer, nothing is changed until the plan is accepted
+        from planner import estimate, print_estimate
+        plan = estimate({**found_layer, selected_key: new_value})
+        if plan is None:
+            print('Could not plan the regeneration, the capabilities of the layer are not available')
             print('Exiting...')
             time.sleep(2)
             return
-    for layer in cesium_layers_json:
-        if found_layer == layer:
-            layer[selected_key] = new_value
-            with open(ASSETS_JSON, 'w', encoding='utf-8') as f:
-                json.dump(cesium_layers_json, f, indent=4)
-            print('Json document updated')
-            clear_previous_lines(n=2)
-            if selected_key == 'Url':
-                print('Downloading layer from updated Url...')
-                asset = Asset(found_layer)
-                asset.download_wms_layer(quadrants=N_QUADRANTS, quadrant_size=QUADRANT_SIZE)
-                asset.create_new_asset()
-                clear_previous_lines(n=2)
-                print('Uploading downloaded layer to Cesium...')
-                asset.upload_to_cesium()
-                clear_previous_lines(n=1)
-                delete_cesium_asset(found_layer['Id'])
-                delete_local_layer(asset.name)
-                for layer in cesium_layers_json:
-                    if found_layer == layer:
-                        layer['Id'] = int(asset.id)
-                        with open(ASSETS_JSON, 'w', encoding='utf-8') as f:
-                            json.dump(cesium_layers_json, f, indent=4)
+        lines = print_estimate(plan)
+        while True:
+            proceed = input('Do you want to regenerate the layer? [y/n]\n')
+            if proceed.lower() == 'y':
+                clear_previous_lines(n=lines + 2)
                 break
+            if proceed.lower() == 'n':
+                print('Exiting...')
+                time.sleep(2)
+                return
+            clear_previous_lines(n=2)
+    print(f'Updating {selected_key} as {new_value}')
+    # The change is journaled right away, the file itself is written once at the end
+    catalog.update(chosen, selected_key, new_value)
+    if catalog.source_of(chosen) == ARCGIS_JSON:
+        catalog.save()
+        print('Json document updated')
+        print('Exiting...')
+        time.sleep(2)
+        return
+    if selected_key in REGENERATE_FIELDS:
+        try:
+            regenerate_layer(catalog, chosen)
+        except RuntimeError as e:
+            # The edit stays in the journal, the next session offers to apply it again
+            print(f'Error: {str(e)}')
+            print('Exiting...')
+            time.sleep(2)
+            return
+    catalog.save()
+    print('Json document updated')
+    clear_previous_lines(n=2)
     print('Process completed')
     print('Exiting...')
     time.sleep(2)
@@ -149,7 +322,20 @@ def main():
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--edits', help='json file with a list of edits to apply without prompting')
+    parser.add_argument('--queue', action='store_true',
+                        help='with --edits, submit the layers to regenerate to the worker queue')
+    args = parser.parse_args()
+    collect_garbage()
+    if args.edits:
+        to_regenerate = bulk_edit(args.edits)
+        if args.queue and to_regenerate:
+            from worker import submit
+            for job_id, layer in zip(submit([layer['Name'] for layer in to_regenerate]), to_regenerate):
+                print(f'Job {job_id}: {layer['Name']}')
+    else:
+        main()
     sys.exit(0)
 
 
@@ -0,0 +1,106 @@
+from contextlib import contextmanager
+from datetime import datetime
+import config
+import json
+import time
+import os
+
+
+METRICS_DIR = getattr(config, 'METRICS_DIR', 'metrics')
+
+
+class RunMetrics:
+    """Collects one record per pipeline stage of a layer regeneration
+    (token, capabilities, each tile's fetch/translate/alpha, merge,
+    create asset, upload, swap) and exports them at the end of the run
+    """
+    def __init__(self, layer_name, url=None):
+        self.layer_name = layer_name
+        self.url = url
+        self.started = datetime.now()
+        self.records = []
+
+    @contextmanager
+    def stage(self, name, **fields):
+        """Times the wrapped block and stores it as a record. The yielded
+        dict can be updated inside the block, e.g. with bytes or retries
+        """
+        record = {'stage': name, 'bytes': 0, 'retries': 0, 'ok': True}
+        record.update(fields)
+        begin = time.perf_counter()
+        try:
+            yield record
+        except BaseException:
+            record['ok'] = False
+            raise
+        finally:
+            record['duration'] = time.perf_counter() - begin
+            self.records.append(record)
+
+    def add(self, name, duration, **fields):
+        """Stores a record for a stage that was timed elsewhere"""
+        record = {'stage': name, 'bytes': 0, 'retries': 0, 'ok': True, 'duration': duration}
+        record.update(fields)
+        self.records.append(record)
+
+    def durations(self, name):
+        return [r['duration'] for r in self.records if r['stage'] == name]
+
+    def summary(self):
+        """Aggregates the records by stage"""
+        summary = {}
+        for record in self.records:
+            stage = summary.setdefault(record['stage'], {
+                'count': 0, 'duration': 0.0, 'bytes': 0, 'retries': 0, 'failed': 0
+            })
+            stage['count'] += 1
+            stage['duration'] += record['duration']
+            stage['bytes'] += record['bytes']
+            stage['retries'] += record['retries']
+            if not record['ok']:
+                stage['failed'] += 1
+        return summary
+
+    def to_prometheus(self):
+        """Renders the per-stage summary in the Prometheus text format"""
+        layer = self.layer_name.replace('\\', '\\\\').replace('"', '\\"')
+        lines = [
+            '# HELP xr_stage_duration_seconds Time spent in each pipeline stage',
+            '# TYPE xr_stage_duration_seconds summary',
+        ]
+        summary = self.summary()
+        for stage, values in summary.items():
+            labels = f'layer="{layer}",stage="{stage}"'
+            lines.append(f'xr_stage_duration_seconds_sum{{{labels}}} {values["duration"]:.6f}')
+            lines.append(f'xr_stage_duration_seconds_count{{{labels}}} {values["count"]}')
+        for metric, key, help_text in (
+            ('xr_stage_bytes_total', 'bytes', 'Bytes produced or transferred by each stage'),
+            ('xr_stage_retries_total', 'retries', 'Retries done by each stage'),
+            ('xr_stage_failures_total', 'failed', 'Failed executions of each stage'),
+        ):
+            lines.append(f'# HELP {metric} {help_text}')
+            lines.append(f'# TYPE {metric} counter')
+            for stage, values in summary.items():
+                lines.append(f'{metric}{{layer="{layer}",stage="{stage}"}} {values[key]}')
+        return '\n'.join(lines) + '\n'
+
+    def write(self, directory=METRICS_DIR):
+        """Writes the run as <layer>_<timestamp>.json and .prom files
+        in directory and returns the path of the json file
+        """
+        os.makedirs(directory, exist_ok=True)
+        base_name = f'{self.layer_name.replace(".tiff", "")}_{self.started.strftime("%Y%m%d_%H%M%S")}'
+        json_path = os.path.join(directory, base_name + '.json')
+        document = {
+            'layer': self.layer_name,
+            'url': self.url,
+            'started': self.started.isoformat(),
+            'finished': datetime.now().isoformat(),
+            'summary': self.summary(),
+            'records': self.records,
+        }
+        with open(json_path, 'w') as f:
+            json.dump(document, f, indent=4)
+        with open(os.path.join(directory, base_name + '.prom'), 'w') as f:
+            f.write(self.to_prometheus())
+        return json_path
@@ -0,0 +1,162 @@
+from history import HISTORY_DB, load_runs
+from scheduler import host_of
+from metrics import METRICS_DIR
+from datetime import datetime
+from config import *
+import statistics
+import argparse
+import json
+import sys
+import os
+
+
+def load_history(directory=METRICS_DIR, path=HISTORY_DB):
+    """This function returns, for each previous run that downloaded tiles,
+    its host and its per-tile figures: wall seconds, downloaded bytes and
+    output bytes, plus the upload rate. They come from the history database,
+    or from the files written by RunMetrics.write if there is none yet
+    """
+    if os.path.exists(path):
+        return load_runs(path)
+    runs = []
+    if not os.path.isdir(directory):
+        return runs
+    for file in os.listdir(directory):
+        if not file.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, file), 'r') as f:
+                document = json.load(f)
+        except Exception:
+            continue
+        summary = document.get('summary', {})
+        tiles = summary.get('fetch', {}).get('count', 0) + summary.get('duplicate', {}).get('count', 0)
+        if not tiles or 'merge' not in summary:
+            continue
+        elapsed = (datetime.fromisoformat(document['finished']) - datetime.fromisoformat(document['started'])).total_seconds()
+        # Only the download is proportional to the tiles, creating and uploading the asset are not
+        for stage in ('create_asset', 'upload', 'swap'):
+            elapsed -= summary.get(stage, {}).get('duration', 0)
+        # Runs recorded before the serial engine timed open and Translate together have the size on translate
+        downloaded = summary.get('fetch', {}).get('bytes', 0) or summary.get('translate', {}).get('bytes', 0)
+        upload = summary.get('upload', {})
+        runs.append({
+            'host': host_of(document.get('url') or ''),
+            'tile_seconds': max(elapsed, 0) / tiles,
+            'tile_bytes': downloaded / tiles,
+            'output_tile_bytes': summary['merge']['bytes'] / tiles,
+            'upload_rate': upload['bytes'] / upload['duration'] if upload.get('bytes') and upload.get('duration') else None
+        })
+    return runs
+
+
+def median_of(runs, key):
+    values = [run[key] for run in runs if run[key]]
+    return statistics.median(values) if values else None
+
+
+def estimate(layer, quadrants=N_QUADRANTS, quadrant_size=QUADRANT_SIZE, history=None):
+    """This function plans the regeneration of a layer without downloading
+    it: the tile count comes from its capabilities and resolution policy,
+    the sizes and durations from the previous runs on the same WMS host,
+    or from all the previous runs if the host has none. It returns None
+    if the capabilities cannot be read
+    """
+    # GDAL is loaded only when a plan is requested
+    from asset import Asset
+    asset = Asset(layer)
+    capabilities = asset.get_capabilities(quadrants, quadrant_size)
+    if capabilities is None:
+        return None
+    plan = capabilities['plan']
+    history = load_history() if history is None else history
+    host = host_of(asset.url)
+    runs = [run for run in history if run['host'] == host]
+    source = f'{len(runs)} runs on {host}'
+    if not runs:
+        runs = history
+        source = f'{len(runs)} runs on any host' if runs else 'no history'
+
+    tiles = len(plan)
+    result = {
+        'name': asset.name,
+        'tiles': tiles,
+        'grid': (plan.columns, plan.rows),
+        'pixels': tiles * quadrant_size * quadrant_size,
+        'source': source,
+        'download_bytes': None,
+        # Upper bound without history: uncompressed RGBA
+        'output_bytes': tiles * quadrant_size * quadrant_size * 4,
+        'download_seconds': None,
+        'upload_seconds': None,
+    }
+    tile_bytes = median_of(runs, 'tile_bytes')
+    if tile_bytes is not None:
+        result['download_bytes'] = tile_bytes * tiles
+    output_tile_bytes = median_of(runs, 'output_tile_bytes')
+    if output_tile_bytes is not None:
+        result['output_bytes'] = output_tile_bytes * tiles
+    tile_seconds = median_of(runs, 'tile_seconds')
+    if tile_seconds is not None:
+        result['download_seconds'] = tile_seconds * tiles
+    upload_rate = median_of(runs, 'upload_rate')
+    if upload_rate is not None:
+        result['upload_seconds'] = result['output_bytes'] / upload_rate
+    return result
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TB'
+
+
+def format_duration(seconds):
+    if seconds < 60:
+        return f'{int(seconds)} seconds'
+    if seconds < 3600:
+        return f'{round(seconds / 60, 1)} minutes'
+    return f'{round(seconds / 3600, 2)} hours'
+
+
+def print_estimate(result):
+    """This function prints the plan and returns the number of lines printed"""
+    columns, rows = result['grid']
+    print(f'Plan for {result["name"]} (from {result["source"]}):')
+    print(f'  tiles:     {result["tiles"]} ({columns}x{rows}, {result["pixels"] / 1e6:.0f} Mpixels)')
+    download = format_size(result['download_bytes']) if result['download_bytes'] is not None else 'unknown'
+    print(f'  download:  {download}')
+    print(f'  output:    ~{format_size(result["output_bytes"])}')
+    if result['download_seconds'] is None:
+        print('  duration:  unknown, no previous run to compare with')
+        return 5
+    total = result['download_seconds'] + (result['upload_seconds'] or 0)
+    print(f'  duration:  ~{format_duration(total)} (download {format_duration(result["download_seconds"])}'
+          + (f', upload {format_duration(result["upload_seconds"])})' if result['upload_seconds'] is not None else ')'))
+    return 5
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Estimate the cost of regenerating some layers')
+    parser.add_argument('layers', nargs='+', help='names of the layers in ASSETS_JSON')
+    args = parser.parse_args()
+
+    with open(ASSETS_JSON, 'r', encoding='utf-8') as f:
+        layers = {layer['Name']: layer for layer in json.load(f)}
+    history = load_history()
+    for name in args.layers:
+        if name not in layers:
+            print(f'No layer named {name} in {ASSETS_JSON}')
+            continue
+        result = estimate(layers[name], history=history)
+        if result is None:
+            print(f'Could not read the capabilities of {name}')
+            continue
+        print_estimate(result)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
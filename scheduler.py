@@ -0,0 +1,214 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from contextlib import contextmanager
+from urllib.parse import urlparse
+from collections import Counter
+import threading
+import itertools
+import config
+import time
+
+
+MAX_JOBS = getattr(config, 'MAX_JOBS', 4)
+MAX_REQUESTS = getattr(config, 'MAX_REQUESTS', 8)
+MAX_REQUESTS_PER_HOST = getattr(config, 'MAX_REQUESTS_PER_HOST', 2)
+# A response slower than this many times the usual latency counts as congestion
+LATENCY_FACTOR = 3
+
+
+def host_of(url):
+    return (urlparse(url).hostname or '').lower()
+
+
+class HostLimiter:
+    """Caps the GetMap requests in flight at the same time, both in total
+    and for each WMS host, across all the pipelines sharing the limiter
+    """
+    def __init__(self, max_requests=MAX_REQUESTS, max_per_host=MAX_REQUESTS_PER_HOST):
+        self.max_per_host = max_per_host
+        self._global = threading.BoundedSemaphore(max_requests)
+        self._hosts = {}
+        self._lock = threading.Lock()
+
+    def _host_semaphore(self, host):
+        with self._lock:
+            if host not in self._hosts:
+                self._hosts[host] = threading.BoundedSemaphore(self.max_per_host)
+            return self._hosts[host]
+
+    @contextmanager
+    def request(self, url):
+        """Holds a request slot for the host of url while the block runs"""
+        self.acquire(url)
+        try:
+            yield
+        finally:
+            self.release(url)
+
+    def acquire(self, url):
+        """Waits for a request slot for the host of url. The slot is given back with release"""
+        # The host slot is taken first, so a busy host does not hold global slots
+        self._host_semaphore(host_of(url)).acquire()
+        self._global.acquire()
+
+    def try_acquire(self, url):
+        """Takes a request slot for the host of url only if one is free right
+        away and returns whether it did. The slot is given back with release"""
+        host_semaphore = self._host_semaphore(host_of(url))
+        if not host_semaphore.acquire(blocking=False):
+            return False
+        if not self._global.acquire(blocking=False):
+            host_semaphore.release()
+            return False
+        return True
+
+    def release(self, url):
+        self._global.release()
+        self._host_semaphore(host_of(url)).release()
+
+
+class AdaptiveLimit:
+    """Window of GetMap requests in flight that adapts to the server (AIMD):
+    it grows by one request per window of healthy responses and halves on
+    a 429, a 5xx, a network error or a response much slower than the usual
+    latency, at most once per round trip so one burst of slow responses
+    counts as a single congestion signal
+    """
+    def __init__(self, initial=2, minimum=1, maximum=MAX_REQUESTS, latency_factor=LATENCY_FACTOR):
+        self.minimum = minimum
+        self.maximum = max(minimum, maximum)
+        self.latency_factor = latency_factor
+        self.limit = float(min(max(initial, minimum), self.maximum))
+        # Moving average of the latency of the healthy responses
+        self.latency = None
+        self._in_flight = 0
+        self._last_decrease = 0
+        self._condition = threading.Condition()
+
+    @property
+    def window(self):
+        return int(self.limit)
+
+    @contextmanager
+    def request(self):
+        """Waits for a free place in the window and holds it while the block runs"""
+        self.acquire()
+        try:
+            yield
+        finally:
+            self.release()
+
+    def acquire(self):
+        """Waits for a free place in the window. The place is given back with release"""
+        with self._condition:
+            while self._in_flight >= self.window:
+                self._condition.wait()
+            self._in_flight += 1
+
+    def try_acquire(self):
+        """Takes a place in the window only if one is free right away and
+        returns whether it did. The place is given back with release"""
+        with self._condition:
+            if self._in_flight >= self.window:
+                return False
+            self._in_flight += 1
+            return True
+
+    def release(self):
+        with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    def on_response(self, seconds, status=None, ok=True):
+        """Adapts the window to the outcome of a request"""
+        with self._condition:
+            congested = not ok or status == 429 or (status is not None and status >= 500)
+            if self.latency is not None and seconds > self.latency_factor * self.latency:
+                congested = True
+            if congested:
+                now = time.monotonic()
+                if now - self._last_decrease > (self.latency or 0):
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self._last_decrease = now
+            else:
+                self.latency = seconds if self.latency is None else 0.9 * self.latency + 0.1 * seconds
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self._condition.notify_all()
+
+
+class TokenBucket:
+    """Caps the average download rate at rate bytes per second. The size of
+    a tile is only known once it has arrived, so it is paid afterwards and
+    the next requests wait until the debt is paid back
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else rate)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def consume(self, size):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate) - size
+            self._updated = now
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
+class Scheduler:
+    """Runs several layer pipelines at the same time. When a slot frees up
+    the next job is the one with the highest priority; among equal priorities
+    the job whose host has the fewest pipelines running goes first, so that
+    layers of different servers share the slots fairly, then the one
+    expected to be the shortest (from the run history), then the oldest
+    """
+    def __init__(self, max_jobs=MAX_JOBS, limiter=None):
+        self.max_jobs = max_jobs
+        self.limiter = limiter if limiter is not None else HostLimiter()
+        self._executor = ThreadPoolExecutor(max_workers=max_jobs)
+        self._pending = []
+        self._running = 0
+        self._running_by_host = Counter()
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+
+    def submit(self, host, priority, func, *args, expected_seconds=None, **kwargs):
+        """Queues func(*args, **kwargs) and returns a Future for its result.
+        Jobs whose expected_seconds is unknown are considered short"""
+        future = Future()
+        with self._lock:
+            self._pending.append((priority, next(self._counter), host, func, args, kwargs, future,
+                                  expected_seconds or 0))
+        self._dispatch()
+        return future
+
+    def free_slots(self):
+        with self._lock:
+            return self.max_jobs - self._running - len(self._pending)
+
+    def _dispatch(self):
+        with self._lock:
+            while self._pending and self._running < self.max_jobs:
+                entry = min(self._pending, key=lambda e: (-e[0], self._running_by_host[e[2]], e[7], e[1]))
+                self._pending.remove(entry)
+                self._running += 1
+                self._running_by_host[entry[2]] += 1
+                self._executor.submit(self._run, entry)
+
+    def _run(self, entry):
+        _, _, host, func, args, kwargs, future, _ = entry
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(func(*args, **kwargs))
+            except BaseException as e:
+                # SystemExit from the download code must not kill the thread pool
+                future.set_exception(e)
+        with self._lock:
+            self._running -= 1
+            self._running_by_host[host] -= 1
+        self._dispatch()
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
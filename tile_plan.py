@@ -0,0 +1,111 @@
+import numpy as np
+import json
+
+
+PENDING = 0
+DONE = 1
+FAILED = 2
+# Downloaded, but without any visible pixel
+EMPTY = 3
+STATES = {PENDING: 'pending', DONE: 'done', FAILED: 'failed', EMPTY: 'empty'}
+
+
+class TilePlan:
+    """Grid of the tiles of a layer, stored as an (n, 4) array of extents
+    (minx, miny, maxx, maxy in EPSG:4326) and an array with the state of
+    each tile. Tiles are referenced by their index, row by row starting
+    from the bottom left one, as get_bboxes lists them; index and (row,
+    column) are converted with arithmetic only, so plans of tens of
+    thousands of tiles are built and tracked without any list scan
+    """
+    def __init__(self, extents, columns, rows, state=None):
+        self.extents = np.asarray(extents, dtype=np.float64).reshape(-1, 4)
+        self.columns = columns
+        self.rows = rows
+        if len(self.extents) != columns * rows:
+            raise ValueError(f'{len(self.extents)} extents for a grid of {columns}x{rows} tiles')
+        self.state = np.zeros(len(self.extents), dtype=np.uint8) if state is None else np.asarray(state, dtype=np.uint8)
+
+    @classmethod
+    def grid(cls, extent, columns, rows=None):
+        """Splits extent in columns x rows tiles (a square grid if rows is
+        not given). Each edge is computed once and shared by the tiles on
+        both of its sides, the last one is the extent itself
+        """
+        if rows is None:
+            rows = columns
+        minx, miny, maxx, maxy = extent
+        edges_x = np.append(minx + (maxx - minx) * np.arange(columns) / columns, maxx)
+        edges_y = np.append(miny + (maxy - miny) * np.arange(rows) / rows, maxy)
+        extents = np.empty((rows, columns, 4), dtype=np.float64)
+        extents[:, :, 0] = edges_x[:-1]
+        extents[:, :, 1] = edges_y[:-1, np.newaxis]
+        extents[:, :, 2] = edges_x[1:]
+        extents[:, :, 3] = edges_y[1:, np.newaxis]
+        return cls(extents, columns, rows)
+
+    def __len__(self):
+        return len(self.extents)
+
+    @property
+    def extent(self):
+        minx, miny = self.extents[0, :2]
+        maxx, maxy = self.extents[-1, 2:]
+        return float(minx), float(miny), float(maxx), float(maxy)
+
+    def index(self, row, column):
+        return row * self.columns + column
+
+    def position(self, index):
+        """Returns the (row, column) of the tile at index"""
+        return divmod(index, self.columns)
+
+    def bbox(self, index):
+        """Returns the extent of the tile as the 'miny,minx,maxy,maxx' string
+        of the GetMap requests. repr gives the shortest string that is parsed
+        back to the same float
+        """
+        minx, miny, maxx, maxy = (float(value) for value in self.extents[index])
+        return f'{miny!r},{minx!r},{maxy!r},{maxx!r}'
+
+    def bboxes(self):
+        return [self.bbox(index) for index in range(len(self))]
+
+    def mark(self, index, state):
+        self.state[index] = state
+
+    def indexes(self, state):
+        """Returns the indexes of the tiles in the given state"""
+        return np.flatnonzero(self.state == state).tolist()
+
+    def pending(self):
+        return self.indexes(PENDING)
+
+    def failed(self):
+        return self.indexes(FAILED)
+
+    def counts(self):
+        """Returns the number of tiles in each state, by state name"""
+        counts = np.bincount(self.state, minlength=len(STATES))
+        return {name: int(counts[state]) for state, name in STATES.items()}
+
+    def to_dict(self):
+        return {
+            'columns': self.columns,
+            'rows': self.rows,
+            'extents': self.extents.tolist(),
+            'state': self.state.tolist()
+        }
+
+    @classmethod
+    def from_dict(cls, document):
+        return cls(document['extents'], document['columns'], document['rows'], document['state'])
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f)
+
+    @classmethod
+    def load(cls, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return cls.from_dict(json.load(f))
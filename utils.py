@@ -55,7 +55,7 @@ def delete_local_layer(name):
     for file in os.listdir(FILES_DIR):
         if file == name:
             try:
-                os.remove(file)
+                os.remove(os.path.join(FILES_DIR, file))
             except:
                 pass
 
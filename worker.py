@@ -0,0 +1,255 @@
+from datetime import datetime
+from scheduler import Scheduler, HostLimiter, host_of, MAX_JOBS
+from history import expected_duration
+from workspace import collect_garbage
+from catalog import LayerCatalog
+from config import *
+import traceback
+import threading
+import argparse
+import sqlite3
+import socket
+import config
+import time
+import sys
+import os
+
+
+JOBS_DB = getattr(config, 'JOBS_DB', 'jobs.sqlite')
+POLL_INTERVAL = 5
+# A running job whose worker has not sent a heartbeat for this long is queued again
+LEASE_SECONDS = 120
+HEARTBEAT_INTERVAL = 30
+# Serializes the read-modify-write of the json files between concurrent jobs
+catalog_lock = threading.Lock()
+
+
+def connect(path=JOBS_DB):
+    """This function opens the jobs database, creating the table the first time"""
+    connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+    connection.row_factory = sqlite3.Row
+    connection.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            layer TEXT NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            submitted TEXT NOT NULL,
+            started TEXT,
+            finished TEXT,
+            result TEXT,
+            error TEXT,
+            priority INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    columns = [row['name'] for row in connection.execute('PRAGMA table_info(jobs)')]
+    if 'priority' not in columns:
+        connection.execute('ALTER TABLE jobs ADD COLUMN priority INTEGER NOT NULL DEFAULT 0')
+    if 'worker' not in columns:
+        connection.execute('ALTER TABLE jobs ADD COLUMN worker TEXT')
+        connection.execute('ALTER TABLE jobs ADD COLUMN heartbeat REAL')
+    return connection
+
+
+def submit(layer_names, path=JOBS_DB, priority=0):
+    """This function queues a regeneration job for each layer name and
+    returns the ids of the jobs. Jobs with a higher priority run first"""
+    connection = connect(path)
+    ids = []
+    for name in layer_names:
+        cursor = connection.execute(
+            'INSERT INTO jobs (layer, submitted, priority) VALUES (?, ?, ?)',
+            (name, datetime.now().isoformat(), priority)
+        )
+        ids.append(cursor.lastrowid)
+    connection.close()
+    return ids
+
+
+def requeue_expired(connection):
+    """This function queues again the jobs left running by a worker that
+    died, the ones whose heartbeat is older than LEASE_SECONDS"""
+    connection.execute(
+        "UPDATE jobs SET status = 'pending', started = NULL, worker = NULL "
+        "WHERE status = 'running' AND (heartbeat IS NULL OR heartbeat < ?)",
+        (time.time() - LEASE_SECONDS,)
+    )
+
+
+def heartbeat(path, worker_id, interval=HEARTBEAT_INTERVAL):
+    """This function renews, forever, the lease of the jobs the worker is running"""
+    connection = connect(path)
+    while True:
+        connection.execute(
+            "UPDATE jobs SET heartbeat = ? WHERE worker = ? AND status = 'running'", (time.time(), worker_id)
+        )
+        time.sleep(interval)
+
+
+def claim(connection, worker_id=None):
+    """This function marks the oldest pending job as running by worker_id and
+    returns it, or None if the queue is empty. The update only succeeds for
+    one worker even if several are polling the same database"""
+    requeue_expired(connection)
+    while True:
+        row = connection.execute("SELECT id FROM jobs WHERE status = 'pending' ORDER BY priority DESC, id LIMIT 1").fetchone()
+        if row is None:
+            return None
+        cursor = connection.execute(
+            "UPDATE jobs SET status = 'running', started = ?, worker = ?, heartbeat = ? "
+            "WHERE id = ? AND status = 'pending'",
+            (datetime.now().isoformat(), worker_id, time.time(), row['id'])
+        )
+        if cursor.rowcount == 1:
+            return connection.execute('SELECT * FROM jobs WHERE id = ?', (row['id'],)).fetchone()
+
+
+def finish(connection, job_id, status, result=None, error=None):
+    connection.execute(
+        'UPDATE jobs SET status = ?, finished = ?, result = ?, error = ? WHERE id = ?',
+        (status, datetime.now().isoformat(), result, error, job_id)
+    )
+
+
+def load_catalog(journal=False):
+    # Journals belong to the interactive sessions, the worker saves its changes right away
+    catalog = LayerCatalog(key_fields=('Id', 'Name'), journal=journal)
+    catalog.load(ARCGIS_JSON)
+    catalog.load(ASSETS_JSON)
+    return catalog
+
+
+def find_layer(catalog, name):
+    position = next((p for p in catalog.find('Name', name) if catalog.source_of(p) == ASSETS_JSON), None)
+    if position is None:
+        raise ValueError(f'No layer named {name} in {ASSETS_JSON}')
+    return position
+
+
+def save_fields(name, fields):
+    """This function writes the fields of the layer on a fresh copy of the
+    catalog, so that concurrent jobs do not overwrite each other's changes"""
+    with catalog_lock:
+        catalog = load_catalog()
+        position = find_layer(catalog, name)
+        for field, value in fields.items():
+            catalog.update(position, field, value)
+        catalog.save()
+
+
+def run_job(job, limiter=None):
+    """This function regenerates the layer of a job. The catalog is loaded for
+    every job, since the json files may have been edited in the meantime, and
+    the new Id, as well as the one of the preview with PREVIEW_FIRST, is
+    written back with save_fields"""
+    from main import regenerate_layer
+    with catalog_lock:
+        # Read only copy, the changes done by regenerate_layer on it are not saved
+        catalog = load_catalog(journal=False)
+    asset = regenerate_layer(catalog, find_layer(catalog, job['layer']), limiter=limiter,
+                             persist=lambda fields: save_fields(job['layer'], fields))
+    save_fields(job['layer'], {'Id': int(asset.id), 'Fingerprint': asset.fingerprint})
+    return f'Id {asset.id}'
+
+
+def run_and_record(job, path, limiter=None):
+    """This function runs a job and stores its outcome in the queue"""
+    print(f'Job {job["id"]}: regenerating {job["layer"]}')
+    connection = connect(path)
+    try:
+        result = run_job(job, limiter)
+    except (Exception, SystemExit) as e:
+        # The download code exits the process on errors, the worker must survive it
+        finish(connection, job['id'], 'failed', error=f'{type(e).__name__}: {e}\n{traceback.format_exc()}')
+        print(f'Job {job["id"]}: failed')
+    else:
+        finish(connection, job['id'], 'done', result=result)
+        print(f'Job {job["id"]}: done ({result})')
+    connection.close()
+
+
+def serve(path=JOBS_DB, poll_interval=POLL_INTERVAL, jobs=1, worker_id=None):
+    """This function runs the jobs of the queue forever, up to jobs of them at
+    the same time. GDAL, the HTTP session and the WMS token are loaded once
+    and stay warm between jobs. Several workers can serve the same queue"""
+    # Imported here so that they are loaded once, before the first job
+    import asset
+    # Workspaces of the jobs that were running when a worker died
+    collect_garbage()
+    worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}'
+    connection = connect(path)
+    threading.Thread(target=heartbeat, args=(path, worker_id), daemon=True).start()
+    print(f'Worker {worker_id} waiting for jobs in {path}')
+    if jobs == 1:
+        while True:
+            job = claim(connection, worker_id)
+            if job is None:
+                time.sleep(poll_interval)
+                continue
+            run_and_record(job, path)
+
+    scheduler = Scheduler(max_jobs=jobs, limiter=HostLimiter())
+    while True:
+        while scheduler.free_slots() > 0:
+            job = claim(connection, worker_id)
+            if job is None:
+                break
+            try:
+                with catalog_lock:
+                    catalog = load_catalog(journal=False)
+                host = host_of(catalog[find_layer(catalog, job['layer'])]['Url'])
+            except Exception:
+                # run_and_record will report the problem
+                host = ''
+            scheduler.submit(host, job['priority'], run_and_record, job, path, scheduler.limiter,
+                             expected_seconds=expected_duration(job['layer']))
+        time.sleep(poll_interval)
+
+
+def status(job_id=None, path=JOBS_DB):
+    """This function prints the state of one job, or of the last 20"""
+    connection = connect(path)
+    if job_id is not None:
+        rows = connection.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchall()
+    else:
+        rows = connection.execute('SELECT * FROM jobs ORDER BY id DESC LIMIT 20').fetchall()
+    connection.close()
+    for row in rows:
+        print(f'{str(row["id"]).ljust(5)} {row["status"].ljust(8)} {row["layer"]}')
+        print(f'      submitted {row["submitted"]}  started {row["started"] or "-"}  finished {row["finished"] or "-"}')
+        if row['result']:
+            print(f'      {row["result"]}')
+        if row['error'] and job_id is not None:
+            print(row['error'])
+        elif row['error']:
+            print(f'      {row["error"].splitlines()[0]}')
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Layer regeneration worker')
+    parser.add_argument('--db', default=JOBS_DB)
+    commands = parser.add_subparsers(dest='command', required=True)
+    serve_parser = commands.add_parser('serve', help='run the queued jobs')
+    serve_parser.add_argument('--poll', type=float, default=POLL_INTERVAL)
+    serve_parser.add_argument('--jobs', type=int, default=1,
+                              help=f'layers regenerated at the same time (e.g. {MAX_JOBS})')
+    serve_parser.add_argument('--id', help='name of this worker (default host-pid)')
+    submit_parser = commands.add_parser('submit', help='queue the regeneration of some layers')
+    submit_parser.add_argument('layers', nargs='+', help='names of the layers in ASSETS_JSON')
+    submit_parser.add_argument('--priority', type=int, default=0)
+    status_parser = commands.add_parser('status', help='show the state of the jobs')
+    status_parser.add_argument('id', nargs='?', type=int)
+    args = parser.parse_args()
+
+    if args.command == 'serve':
+        serve(args.db, args.poll, args.jobs, args.id)
+    elif args.command == 'submit':
+        for job_id, name in zip(submit(args.layers, args.db, args.priority), args.layers):
+            print(f'Job {job_id}: {name}')
+    elif args.command == 'status':
+        status(args.id, args.db)
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
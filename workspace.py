@@ -0,0 +1,131 @@
+from datetime import datetime
+from config import *
+import statistics
+import argparse
+import shutil
+import config
+import time
+import sys
+import os
+
+
+# Where the tiles of the runs are written, e.g. a tmpfs or NVMe mount. The merged layers stay in FILES_DIR
+SCRATCH_DIR = getattr(config, 'SCRATCH_DIR', FILES_DIR)
+# Workspaces untouched for longer than this were left behind by a run that crashed
+STALE_HOURS = getattr(config, 'STALE_HOURS', 24)
+# Space kept free on every disk on top of what a run needs
+FREE_SPACE_MARGIN = getattr(config, 'FREE_SPACE_MARGIN', 1024 ** 3)
+# False to skip the free space check before the downloads
+FREE_SPACE_CHECK = getattr(config, 'FREE_SPACE_CHECK', True)
+# Size of the LZW tiles relative to their RGBA pixels, assumed when no previous run can tell
+COMPRESSION_GUESS = getattr(config, 'COMPRESSION_GUESS', 0.25)
+
+
+def workspace_path(name):
+    """This function returns the directory of the tiles of a layer"""
+    return os.path.join(SCRATCH_DIR, f'temp_{os.path.basename(name).replace('.tiff', '')}')
+
+
+def create(name):
+    path = workspace_path(name)
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def remove(name):
+    """This function deletes the workspace of a layer with everything in it"""
+    shutil.rmtree(workspace_path(name), ignore_errors=True)
+
+
+def last_modified(path):
+    """This function returns the time of the newest change in a workspace,
+    the directory itself or any of the files directly inside it"""
+    newest = os.path.getmtime(path)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            try:
+                newest = max(newest, entry.stat().st_mtime)
+            except OSError:
+                pass
+    return newest
+
+
+def collect_garbage(max_age_hours=STALE_HOURS):
+    """This function deletes the workspaces of SCRATCH_DIR and FILES_DIR that
+    have not been written for max_age_hours and returns their paths"""
+    removed = []
+    limit = time.time() - max_age_hours * 3600
+    for directory in {SCRATCH_DIR, FILES_DIR}:
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.listdir(directory):
+            path = os.path.join(directory, entry)
+            if entry.startswith('temp_') and os.path.isdir(path) and last_modified(path) < limit:
+                shutil.rmtree(path, ignore_errors=True)
+                removed.append(path)
+    return removed
+
+
+def estimate_bytes(tiles, quadrant_size, host=None):
+    """This function returns the expected size of the tiles of a run and
+    whether it was measured: from the previous runs on the same host if the
+    history has any, otherwise the RGBA pixels scaled by COMPRESSION_GUESS
+    """
+    from history import HISTORY_DB, load_runs
+    if os.path.exists(HISTORY_DB):
+        sizes = [run['output_tile_bytes'] for run in load_runs() if run['host'] == host and run['output_tile_bytes']]
+        if sizes:
+            return int(statistics.median(sizes) * tiles), True
+    return int(tiles * quadrant_size * quadrant_size * 4 * COMPRESSION_GUESS), False
+
+
+def check_free_space(tiles_bytes, output_bytes, strict=True):
+    """This function raises if the disks of SCRATCH_DIR and FILES_DIR cannot
+    hold the tiles and the merged layer, so that a run fails before its
+    download instead of at the merge. When both are on the same disk, the
+    two sizes are added up. Without strict, for sizes that are only a guess,
+    it prints a warning instead
+    """
+    needs = {}
+    for directory, size in ((SCRATCH_DIR, tiles_bytes), (FILES_DIR, output_bytes)):
+        os.makedirs(directory, exist_ok=True)
+        need = needs.setdefault(os.stat(directory).st_dev, [directory, 0])
+        need[1] += size
+    for directory, size in needs.values():
+        free = shutil.disk_usage(directory).free
+        if free < size + FREE_SPACE_MARGIN:
+            message = (f'Not enough free space in {directory}: {free / 1024 ** 3:.1f} GB free, '
+                       f'{(size + FREE_SPACE_MARGIN) / 1024 ** 3:.1f} GB needed')
+            if strict:
+                raise RuntimeError(message)
+            print(f'Warning: {message} (estimated without history)')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Workspaces of the tiles of the runs')
+    commands = parser.add_subparsers(dest='command', required=True)
+    gc_parser = commands.add_parser('gc', help='delete the workspaces left behind by crashed runs')
+    gc_parser.add_argument('--hours', type=float, default=STALE_HOURS, help='age of the workspaces to delete')
+    commands.add_parser('list', help='show the workspaces and their size')
+    args = parser.parse_args()
+
+    if args.command == 'gc':
+        removed = collect_garbage(args.hours)
+        for path in removed:
+            print(f'Deleted {path}')
+        print(f'{len(removed)} workspaces deleted')
+    elif args.command == 'list':
+        for directory in {SCRATCH_DIR, FILES_DIR}:
+            if not os.path.isdir(directory):
+                continue
+            for entry in sorted(os.listdir(directory)):
+                path = os.path.join(directory, entry)
+                if entry.startswith('temp_') and os.path.isdir(path):
+                    size = sum(os.path.getsize(os.path.join(path, file)) for file in os.listdir(path))
+                    modified = datetime.fromtimestamp(last_modified(path)).strftime('%Y-%m-%d %H:%M')
+                    print(f'{path.ljust(60)} {size / 1024 ** 2:10.1f} MB  last written {modified}')
+
+
+if __name__ == '__main__':
+    main()
+    sys.exit(0)
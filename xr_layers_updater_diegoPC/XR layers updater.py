@@ -4,9 +4,12 @@ from utils import (
     delete_cesium_asset,
     delete_dir,
 )
-from asset import Asset
+from catalog import LayerCatalog, write_json_atomic
+from ftp_transport import FtpTransport
 from config import *
+import argparse
 import platform
+import hashlib
 import ftplib
 import json
 import os
@@ -27,29 +30,121 @@ CHANGEABLE_FIELDS = [
     "ArcgisWmsUrl"
 ]
 MULTIPLE_FIELDS = ["ParentName", "ParentUrl"]
+# Fields of the ASSETS_JSON layers whose change requires a regeneration
+REGENERATE_FIELDS = ["ArcgisWmsUrl"]
+
+
+# Local record of the remote size/modification time of the json files we hold
+FTP_MANIFEST = ".ftp_manifest.json"
+ftp_transport = None
+
+
+"""
+This function reads the manifest of the files downloaded in the previous runs
+"""
+def load_manifest():
+    try:
+        with open(FTP_MANIFEST, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+"""
+This function returns the sha256 of the content of a local file
+"""
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+"""
+This function collects the size and the modification time of the json files on the server,
+using a single MLSD listing when the server supports it and SIZE/MDTM per file otherwise
+"""
+def remote_facts(ftp):
+    facts = {}
+    try:
+        for name, entry in ftp.mlsd(facts=["size", "modify", "type"]):
+            if entry.get("type", "file") == "file" and name.endswith(".json"):
+                facts[name] = {"size": entry.get("size"), "modify": entry.get("modify")}
+        return facts
+    except ftplib.error_perm:
+        pass
+    for name in ftp.nlst():
+        if not name.endswith(".json"):
+            continue
+        try:
+            size = str(ftp.size(name))
+        except ftplib.error_perm:
+            size = None
+        try:
+            modify = ftp.sendcmd("MDTM " + name).split()[-1]
+        except ftplib.error_perm:
+            modify = None
+        facts[name] = {"size": size, "modify": modify}
+    return facts
+
+
+"""
+This function returns the FTP transport shared by the download and the upload of the run,
+opening it the first time it is needed
+"""
+def get_ftp_transport():
+    global ftp_transport
+    if ftp_transport is None:
+        ftp_transport = FtpTransport(HOSTNAME_FTP, PORT_FTP, USERNAME_FTP, PASSWORD_FTP, directory="Layers")
+    return ftp_transport
 
 
 """
 In this function we make the call to a server in order to obtain the json files we need
 to proceed with the main scope of the app, to be able to modify and update the layer data 
-and generate a TIFF file
+and generate a TIFF file. Only the files whose size or modification time on the server
+differ from the ones stored in the manifest (or that are missing locally) are downloaded,
+in parallel over the sessions of the FTP transport
 """
 def download_ftp():
     try:
         current_dir = os.getcwd()
-        ftp = ftplib.FTP()
-        ftp.connect(HOSTNAME_FTP, PORT_FTP)
-        ftp.login(USERNAME_FTP, PASSWORD_FTP)
-        cwd = ftp.cwd("Layers") # Specify the dir where the files are
-        files = ftp.nlst()
+        transport = get_ftp_transport()
+        manifest = load_manifest()
+        with transport.session() as ftp:
+            facts_by_file = remote_facts(ftp)
         json_files = []
-        for file in files:
-            if file.endswith(".json"):
-                save_path = os.path.join(current_dir, file)
-                with open(save_path, "wb") as f:
+        to_download = []
+        for file, facts in facts_by_file.items():
+            save_path = os.path.join(current_dir, file)
+            cached = manifest.get(file, {})
+            up_to_date = (
+                os.path.exists(save_path)
+                and None not in facts.values()
+                and cached.get("size") == facts["size"]
+                and cached.get("modify") == facts["modify"]
+            )
+            if not up_to_date:
+                to_download.append((file, save_path))
+            json_files.append(save_path)
+
+        def retrieve(ftp, item):
+            file, save_path = item
+            # A transfer that fails halfway must not leave a truncated catalog, upload_ftp would push it
+            temp_path = save_path + ".part"
+            try:
+                with open(temp_path, "wb") as f:
                     ftp.retrbinary("RETR " + file, f.write)
-                json_files.append(save_path)
-        ftp.quit()
+                os.replace(temp_path, save_path)
+            finally:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+            return file, file_sha256(save_path)
+
+        for file, sha256 in transport.map(retrieve, to_download):
+            manifest[file] = dict(facts_by_file[file], sha256=sha256)
+        write_json_atomic(FTP_MANIFEST, manifest)
         return json_files
     except ftplib.all_errors as e:
         print(f"FTP error: {e}")
@@ -61,21 +156,49 @@ def download_ftp():
 
 """
 Once we have obtained the files and we have done the modifications,
-we upload on the server the files modified. 
-After that, we remove the files from the local
+we upload on the server the files modified, i.e. the ones whose content hash differs
+from the one of the version we downloaded. Each file is stored under a temp name
+and then renamed over the live one, so nobody can read a half-written catalog.
+The files are kept locally as a cache for the next run, and the manifest is
+updated with their new hash, size and modification time on the server
 """
 def upload_ftp():
     try:
-        session = ftplib.FTP()
-        session.connect(HOSTNAME_FTP, PORT_FTP)
-        session.login(USERNAME_FTP, PASSWORD_FTP)
-        session.cwd("Layers")
-        changed_files = [f for f in os.listdir(os.getcwd()) if f.endswith(".json")]
-        for file in changed_files:
+        manifest = load_manifest()
+        changed_files = []
+        for file in os.listdir(os.getcwd()):
+            if not file.endswith(".json") or file == FTP_MANIFEST:
+                continue
+            # Only the catalogs that came from the server, e.g. not the --edits file
+            if "sha256" not in manifest.get(file, {}):
+                continue
+            sha256 = file_sha256(file)
+            if manifest[file]["sha256"] != sha256:
+                changed_files.append((file, sha256))
+        if not changed_files:
+            return
+        transport = get_ftp_transport()
+
+        def store(session, item):
+            file, sha256 = item
+            temp_name = f".{file}.uploading"
             with open(file, "rb") as local_file:
-                session.storbinary(f"STOR {file}", local_file)
-            os.remove(file)
-        session.quit()
+                session.storbinary(f"STOR {temp_name}", local_file)
+            try:
+                session.rename(temp_name, file)
+            except ftplib.error_perm:
+                # Some servers refuse to rename over an existing file
+                session.delete(file)
+                session.rename(temp_name, file)
+
+        transport.map(store, changed_files)
+        for file, sha256 in changed_files:
+            manifest[file] = {"sha256": sha256}
+        with transport.session() as session:
+            for file, facts in remote_facts(session).items():
+                if file in manifest and "size" not in manifest[file]:
+                    manifest[file].update(facts)
+        write_json_atomic(FTP_MANIFEST, manifest)
     except ftplib.all_errors as e:
         print(f"FTP error: {e}")
         return []
@@ -96,6 +219,123 @@ def maximize_terminal():
         os.system(f"resize -s {rows} {cols}")
 
 
+"""
+This function downloads again the layer at the given position of the catalog from its
+ArcgisWmsUrl, uploads it to Cesium as a new asset, deletes the old one and stores the new
+CesiumId in the catalog
+"""
+def regenerate_layer(catalog, position):
+    # GDAL, numpy and boto3 are only loaded when a regeneration starts
+    from asset import Asset, pixel_fingerprint
+    found_layer = catalog[position]
+    asset = Asset(found_layer)
+    try:
+        print("Downloading layer from updated Url...")
+        asset.download_wms_layer(
+            quadrants=N_QUADRANTS, quadrant_size=QUADRANT_SIZE
+        )
+    except Exception as e:
+        print(f"Something went wrong when downloading the layer: {str(e)}")
+        print("Exiting...")
+        delete_dir(os.path.join(FILES_DIR, "temp_" + asset.name.replace(".tiff", "")))
+        time.sleep(2)
+        return False
+    # Same pixels as the asset on Cesium: nothing to upload
+    fingerprint = pixel_fingerprint(os.path.join(FILES_DIR, asset.name))
+    if fingerprint == found_layer.get("Fingerprint"):
+        clear_previous_lines(n=1)
+        print("The layer has not changed, the asset on Cesium is kept")
+        delete_local_layer(asset.name)
+        return True
+    asset.create_new_asset()
+    # Without a new asset the old one must be kept, and the fingerprint not stored
+    if asset.connection_info is None:
+        print("Something went wrong when creating the new asset on Cesium")
+        print("Exiting...")
+        time.sleep(2)
+        return False
+    clear_previous_lines(n=2)
+    print("Uploading downloaded layer to Cesium...")
+    try:
+        pass
+        asset.upload_to_cesium()
+    except Exception as e:
+        print(
+            f"Something went wrong when uploading the layer to Cesium: {str(e)}"
+        )
+        print("Exiting...")
+        time.sleep(2)
+        return False
+    clear_previous_lines(n=1)
+    try:
+        pass
+        delete_cesium_asset(found_layer["CesiumId"])
+    except Exception as e:
+        print(
+            f"Something went wrong when deleting the old layer on Cesium: {str(e)}"
+        )
+        print("Exiting...")
+        time.sleep(2)
+        return False
+    delete_local_layer(asset.name)# + ".tiff")
+    catalog.update(position, "CesiumId", int(asset.id))
+    catalog.update(position, "Fingerprint", fingerprint)
+    return True
+
+
+"""
+This function applies without any prompt the edits listed in a json file, e.g.
+[{"select": {"ParentUrl": "old"}, "field": "ParentUrl", "value": "new"}],
+loading and saving the json documents only once. Every edit is validated before
+applying any of them. It returns the layers whose ArcgisWmsUrl changed, which
+have to be regenerated
+"""
+def bulk_edit(edits_path):
+    catalog = LayerCatalog(key_fields=("Id", "Name", "CesiumId"), multi_fields=MULTIPLE_FIELDS, journal=True)
+    try:
+        with open(edits_path, "r", encoding="utf-8") as f:
+            edits = json.load(f)
+    except Exception as e:
+        print(f"Error opening {edits_path}: {str(e)}")
+        return None
+    for path in (ARCGIS_JSON, ASSETS_JSON):
+        try:
+            catalog.load(path)
+        except Exception as e:
+            print(f"Error opening {path}: {str(e)}")
+            return None
+    try:
+        changed = catalog.apply_edits(edits, CHANGEABLE_FIELDS)
+    except ValueError as e:
+        print("No change applied, invalid edits:")
+        print(str(e))
+        return None
+    catalog.save()
+    print(f"{len(changed)} fields updated")
+    to_regenerate = sorted({
+        position for position, field in changed
+        if field in REGENERATE_FIELDS and catalog.source_of(position) == ASSETS_JSON
+    })
+    if to_regenerate:
+        print("Layers to regenerate:")
+        for position in to_regenerate:
+            layer_name = catalog[position]["Name"]
+            print(f"  {layer_name}")
+    return [catalog[position] for position in to_regenerate]
+
+
+"""
+This function asks whether the changes to the given json file left unsaved by a
+previous session have to be applied
+"""
+def confirm_replay(path, changes):
+    while True:
+        answer = input(f"{changes} unsaved changes to {path} from a previous session. Apply them? [y/n]\n")
+        clear_previous_lines(n=2)
+        if answer.lower() in ("y", "n"):
+            return answer.lower() == "y"
+
+
 """
 With this function we allow the user to interact with the console in order to let them to 
 choose the layer they want, or to do other different actions, like change the values of 
@@ -104,17 +344,17 @@ specific fields inside the layer selected by the user.
 def main():
     print("""--- XR LAYERS UPDATER ---""")
     # opening files downloaded via FTP
+    catalog = LayerCatalog(key_fields=("Id", "Name", "CesiumId"), multi_fields=MULTIPLE_FIELDS, journal=True,
+                           confirm_replay=confirm_replay)
     try:
-        with open(ARCGIS_JSON, "r", encoding="utf-8") as f:
-            arcgis_layers_json = json.load(f)
+        catalog.load(ARCGIS_JSON)
     except Exception as e:
         print(f"Error opening {ARCGIS_JSON}: {str(e)}")
         print("Exiting...")
         time.sleep(5)
         return
     try:
-        with open(ASSETS_JSON, "r", encoding="utf-8") as f:
-            cesium_layers_json = json.load(f)
+        catalog.load(ASSETS_JSON)
     except Exception as e:
         print(f"Error opening {ASSETS_JSON}: {str(e)}")
         print("Exiting...")
@@ -139,7 +379,7 @@ def main():
             time.sleep(2)
             clear_previous_lines(n=3)
     # Displaying the list of layers downloaded via FTP and opened in the beginning of the function
-    layers = arcgis_layers_json + cesium_layers_json
+    layers = catalog.layers
     print("Available layers from the JSON files:")
     for index, layer in enumerate(layers):
         str_index = str(index + 1).ljust(2)
@@ -262,99 +502,45 @@ def main():
             time.sleep(2)
             clear_previous_lines(n=3)
     print(f"Updating {selected_key} as {new_value}")
-    found = False
-    for layer in arcgis_layers_json:
-        if not multiple and found_layer == layer:
-            found = True
-            layer[selected_key] = new_value
-        elif multiple and layer[selected_key] == old_value:
-            found = True
-            layer[selected_key] = new_value
-    if found:
-        # Opening again the files downloaded via FTP in order to write the changes made
-        with open(ARCGIS_JSON, "w") as f:
-            json.dump(arcgis_layers_json, f, indent=4)
+    if multiple:
+        # The inverted index on the MULTIPLE_FIELDS gives the matching layers directly
+        catalog.update_matching(selected_key, old_value, new_value)
+    else:
+        catalog.update(chosen, selected_key, new_value)
+    # The changes are journaled right away and the files downloaded via FTP
+    # are written once, after the optional regeneration
+    if catalog.source_of(chosen) == ARCGIS_JSON:
+        catalog.save()
         print("Json document updated")
         print("Exiting...")
         time.sleep(2)
         return
-
-    for layer in cesium_layers_json:
-        if found_layer == layer:
-            layer[selected_key] = new_value
-            with open(ASSETS_JSON, "w", encoding="utf-8") as f:
-                json.dump(cesium_layers_json, f, indent=4)
-            print("Json document updated")
-            clear_previous_lines(n=2)
-            # In the case the selected field has the name "ArcgisWmsUrl",
-            # the process to create a tiff file is about to start
-            if selected_key == "ArcgisWmsUrl":
+    if selected_key == "ArcgisWmsUrl":
+        update = False
+        while True:
+            # Last interaction
+            # "y" -> proceed with the creation of the TIFF file
+            # "n" -> closing the app
+            print(
+                "Do you want to regenerate the Layer with the updated Url? [y/n]"
+            )
+            print("The process might take some time")
+            proceed_updating = input()
+            if proceed_updating.lower() == "y":
+                clear_previous_lines(n=3)
+                update = True
+                break
+            if proceed_updating.lower() == "n":
                 update = False
-                while True:
-                    # Last interaction
-                    # "y" -> proceed with the creation of the TIFF file
-                    # "n" -> closing the app
-                    print(
-                        "Do you want to regenerate the Layer with the updated Url? [y/n]"
-                    )
-                    print("The process might take some time")
-                    proceed_updating = input()
-                    if proceed_updating.lower() == "y":
-                        clear_previous_lines(n=3)
-                        update = True
-                        break
-                    if proceed_updating.lower() == "n":
-                        update = False
-                        break
-                    else:
-                        print("Please write y for yes or n for no")
-                        time.sleep(2)
-                        clear_previous_lines(n=4)
-                if not update:
-                    break
-                asset = Asset(found_layer)
-                try:
-                    print("Downloading layer from updated Url...")
-                    asset.download_wms_layer(
-                        quadrants=N_QUADRANTS, quadrant_size=QUADRANT_SIZE
-                    )
-                except Exception as e:
-                    print(f"Something went wrong when downloading the layer: {str(e)}")
-                    print("Exiting...")
-                    delete_dir("temp_" + asset.name)
-                    time.sleep(2)
-                    return
-                asset.create_new_asset()
-                clear_previous_lines(n=2)
-                print("Uploading downloaded layer to Cesium...")
-                try:
-                    pass
-                    asset.upload_to_cesium()
-                except Exception as e:
-                    print(
-                        f"Something went wrong when uploading the layer to Cesium: {str(e)}"
-                    )
-                    print("Exiting...")
-                    time.sleep(2)
-                    return
-                clear_previous_lines(n=1)
-                try:
-                    pass
-                    delete_cesium_asset(found_layer["CesiumId"])
-                except Exception as e:
-                    print(
-                        f"Something went wrong when deleting the old layer on Cesium: {str(e)}"
-                    )
-                    print("Exiting...")
-                    time.sleep(2)
-                    return
-                delete_local_layer(asset.name)# + ".tiff")
-                for layer in cesium_layers_json:
-                    if found_layer == layer:
-                        layer["Id"] = int(asset.id)
-                        with open(ASSETS_JSON, "w", encoding="utf-8") as f:
-                            json.dump(cesium_layers_json, f, indent=4)
                 break
+            else:
+                print("Please write y for yes or n for no")
+                time.sleep(2)
+                clear_previous_lines(n=4)
+        if update:
+            regenerate_layer(catalog, chosen)
+    catalog.save()
+    print("Json document updated")
     print("Process completed")
     print("Exiting...")
     time.sleep(2)
@@ -363,8 +549,16 @@ def main():
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--edits", help="json file with a list of edits to apply without prompting")
+    args = parser.parse_args()
     download_ftp()
-    maximize_terminal()
-    main()
+    if args.edits:
+        bulk_edit(args.edits)
+    else:
+        maximize_terminal()
+        main()
     upload_ftp()
+    if ftp_transport is not None:
+        ftp_transport.close()
     sys.exit(0)
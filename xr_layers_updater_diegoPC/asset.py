@@ -1,11 +1,12 @@
 from datetime import datetime, timedelta
 from xml.etree import ElementTree as ET
 from utils import get_existing_assets, delete_dir
+from tile_plan import TilePlan, DONE, FAILED
 from osgeo import gdal
 from config import *
 import numpy as np
 import requests
-import boto3
+import hashlib
 import json
 import time
 import sys
@@ -160,26 +161,29 @@ def get_capabilities(base_url, use_token=False, qs=4):
     miny = float(capabilities.find('.//ns0:BoundingBox', namespace).attrib.get('miny'))
     maxy = float(capabilities.find('.//ns0:BoundingBox', namespace).attrib.get('maxy'))
 
-    n_of_quadrants = qs
-
-    cap_dict['bboxes'] = []
-
-    step_x = (maxx - minx) / n_of_quadrants
-    step_y = (maxy - miny) / n_of_quadrants
-
-    for i in range(n_of_quadrants):
-        for j in range(n_of_quadrants):
-            bbox_minx = minx + j * step_x
-            bbox_maxx = minx + (j + 1) * step_x
-            bbox_miny = miny + i * step_y
-            bbox_maxy = miny + (i + 1) * step_y
-
-            cap_dict['bboxes'].append(f'{bbox_miny},{bbox_minx},{bbox_maxy},{bbox_maxx}')
+    cap_dict['plan'] = TilePlan.grid((minx, miny, maxx, maxy), qs)
 
     cap_dict['title'] = capabilities.find('.//ns0:Title', namespace).text
     return cap_dict
 
 
+"""
+This function hashes the pixels of a raster, with its size and georeferencing,
+reading chunk_rows lines at a time. Two files with the same fingerprint show the
+same image, even if their compression or metadata differ
+"""
+def pixel_fingerprint(path, chunk_rows=1024):
+    dataset = gdal.Open(path)
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f'{dataset.RasterXSize}x{dataset.RasterYSize}x{dataset.RasterCount}'.encode())
+    digest.update(repr(dataset.GetGeoTransform()).encode())
+    for yoff in range(0, dataset.RasterYSize, chunk_rows):
+        rows = min(chunk_rows, dataset.RasterYSize - yoff)
+        digest.update(dataset.ReadRaster(0, yoff, dataset.RasterXSize, rows))
+    dataset = None
+    return digest.hexdigest()
+
+
 """
 This function post processes the downloaded tiff file
 and sets its transparency
@@ -267,7 +271,8 @@ def merge_tiffs(files, output_file):
 
 """
 If some chunk requests have failed this function will 
-try to download those parts of the file again
+try to download those parts of the file again. It returns
+True if the tile was downloaded
 """
 def retry_download(bbox, i, wms_url, g_token, wh, temp_output_tiff, output_files):
     try:
@@ -299,10 +304,12 @@ def retry_download(bbox, i, wms_url, g_token, wh, temp_output_tiff, output_files
         if os.path.exists(output_file_with_idx):
             os.remove(output_file_with_idx)
         output_files.append(output_file_with_idx.replace('.tiff', '_transp.tiff'))
+        return True
     except Exception as e:
         with open('error_log.txt', 'a') as f:
             now = datetime.now
             f.write(f'{now} - file at index {i} - BoundingBox: {bbox} - ERROR:{str(e)}')
+        return False
 
 
 class Asset:
@@ -323,7 +330,6 @@ class Asset:
 
         output_files = []
         time_diffs = []
-        failed = []
 
         try:
             capabilities = get_capabilities(self.url, use_token=True, qs=quadrants)
@@ -341,7 +347,9 @@ class Asset:
 
             g_token = get_token()
 
-            for idx, bbox in enumerate(capabilities['bboxes']):
+            plan = capabilities['plan']
+            for idx in range(len(plan)):
+                bbox = plan.bbox(idx)
                 options = [
                     '-co', 'ALPHA=YES',
                     '-co', 'TILED=YES',
@@ -354,7 +362,7 @@ class Asset:
                 try:
                     wms_dataset = gdal.Open(wms_url_with_size)
                 except:
-                    # failed.append((bbox, i))
+                    plan.mark(idx, FAILED)
                     continue
 
                 if wms_dataset is None:
@@ -362,7 +370,7 @@ class Asset:
                     sys.stdout.flush()
                     return
                 
-                tot_quadrants = quadrants * quadrants
+                tot_quadrants = len(plan)
                 i = idx + 1
 
                 step_begin = time.time()
@@ -393,7 +401,7 @@ class Asset:
 
                 previous_line_len = len(f'\rDownloading {i}/{tot_quadrants}...  {eta_str}')
 
-                output_file_with_idx = temp_output_tiff.replace('.tiff', f'_{i}_{bbox}.tiff')
+                output_file_with_idx = temp_output_tiff.replace('.tiff', f'_{i}.tiff')
                 gdal.Translate(output_file_with_idx, wms_dataset, format='GTiff', width=width, height=height, options=options)
                 
                 output_files.append(output_file_with_idx)
@@ -403,27 +411,28 @@ class Asset:
                 if os.path.exists(output_file_with_idx):
                     os.remove(output_file_with_idx)
                 output_files.append(output_file_with_idx.replace('.tiff', '_transp.tiff'))
+                plan.mark(idx, DONE)
 
                 step_end = time.time()
 
                 elapsed = step_end - step_begin
                 time_diffs.append(elapsed)
 
-            coords = [f.split('_')[2] for f in os.listdir('temp_'+self_name_repl)]
-            actual_bboxes = [bbox for bbox in capabilities['bboxes'] if bbox in coords]
-            failed = [(bbox, i) for i, bbox in enumerate(capabilities['bboxes']) if bbox not in actual_bboxes]
+            # The plan knows which tiles failed, the bboxes are not parsed back from the file names
+            failed = plan.failed()
 
             if failed:
                 print(f'\rRetrying failed downloads...', end='', flush=True)
                 g_token = get_token()
-                for idx, to_retry in enumerate(failed):
+                for n, idx in enumerate(failed):
                     print('\r' + (' ' * previous_line_len), end='', flush=True)
                     sys.stdout.flush()
                     len_failed = len(failed)
-                    print(f'\rRetrying {i} {idx+1}/{len_failed}...', end='', flush=True)
+                    print(f'\rRetrying {idx + 1} {n+1}/{len_failed}...', end='', flush=True)
                     sys.stdout.flush()
-                    previous_line_len = len(f'\rRetrying {i} {idx}/{len_failed}...')
-                    retry_download(to_retry[0], to_retry[1], self.url, g_token, quadrant_size, temp_output_tiff, output_files)  
+                    previous_line_len = len(f'\rRetrying {idx + 1} {n}/{len_failed}...')
+                    if retry_download(plan.bbox(idx), idx + 1, self.url, g_token, quadrant_size, temp_output_tiff, output_files):
+                        plan.mark(idx, DONE)
 
             print('\r' + ' ' * 150, end='\r', flush=True)
             sys.stdout.flush()
@@ -432,7 +441,7 @@ class Asset:
             merge_tiffs([os.path.join(FILES_DIR, 'temp_'+self_name_repl,f) for f in os.listdir(os.path.join(FILES_DIR,'temp_'+self_name_repl))], self.name)
         except Exception as e:
             try:
-                delete_dir(self.name)
+                delete_dir(os.path.join(FILES_DIR, 'temp_' + self_name_repl))
             except:
                 pass
             print(f"Error in download_wms_layer: {str(e)}")
@@ -484,6 +493,7 @@ class Asset:
     In this function we get the recently created asset and we upload it in the cesium account we're using
     """
     def upload_to_cesium(self):
+        import boto3
         if os.path.exists(os.path.join(FILES_DIR, self.name + '.tiff')):
             file_path = os.path.join(FILES_DIR, self.name + '.tiff')
         elif os.path.exists(os.path.join(FILES_DIR, self.name)):
@@ -499,7 +509,5 @@ class Asset:
                 s3.upload_fileobj(data, self.connection_info['bucket_name'], self.connection_info['prefix'] + self.name +'.tiff')
         except Exception as e:
             print('Error:', str(e))
-        try:
-            requests.post(self.connection_info['upload_complete_url'], headers=HEADERS['no_payload'])
-        except:
-            pass
\ No newline at end of file
+            raise
+        requests.post(self.connection_info['upload_complete_url'], headers=HEADERS['no_payload']).raise_for_status()
\ No newline at end of file
@@ -0,0 +1,102 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+import threading
+import config
+import ftplib
+import queue
+import time
+
+
+FTP_USE_TLS = getattr(config, "FTP_USE_TLS", False)
+FTP_POOL_SIZE = getattr(config, "FTP_POOL_SIZE", 4)
+# Sessions idle for longer than this are checked with a NOOP before being reused
+FTP_IDLE_CHECK = 30
+
+
+"""
+Small pool of authenticated FTP (or FTPS) sessions, all positioned in the same
+directory, that is opened once per run and shared by the download and the upload.
+map() runs a transfer function on several files at the same time, each call using
+its own session from the pool
+"""
+class FtpTransport:
+    def __init__(self, host, port, user, password, directory="Layers", use_tls=FTP_USE_TLS, pool_size=FTP_POOL_SIZE):
+        self.host = host
+        self.port = port
+        self.user = user
+        self.password = password
+        self.directory = directory
+        self.use_tls = use_tls
+        self.pool_size = max(1, pool_size)
+        self._idle = queue.LifoQueue()
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        ftp = ftplib.FTP_TLS() if self.use_tls else ftplib.FTP()
+        ftp.connect(self.host, self.port)
+        ftp.login(self.user, self.password)
+        if self.use_tls:
+            ftp.prot_p()
+        ftp.cwd(self.directory)
+        return ftp
+
+    def _acquire(self):
+        with self._lock:
+            can_open = self._opened < self.pool_size and self._idle.empty()
+            if can_open:
+                self._opened += 1
+        if can_open:
+            try:
+                return self._connect()
+            except BaseException:
+                with self._lock:
+                    self._opened -= 1
+                raise
+        ftp, released = self._idle.get()
+        if time.monotonic() - released > FTP_IDLE_CHECK:
+            try:
+                ftp.voidcmd("NOOP")
+            except ftplib.all_errors:
+                ftp.close()
+                ftp = self._connect()
+        return ftp
+
+    @contextmanager
+    def session(self):
+        """Borrows a session from the pool. A session that raised an FTP
+        error is dropped, the next borrower will open a new one"""
+        ftp = self._acquire()
+        try:
+            yield ftp
+        except BaseException:
+            ftp.close()
+            with self._lock:
+                self._opened -= 1
+            raise
+        self._idle.put((ftp, time.monotonic()))
+
+    def map(self, func, items):
+        """Calls func(ftp, item) for every item in parallel over the pool
+        and returns the results in the order of items"""
+        items = list(items)
+        if not items:
+            return []
+
+        def run(item):
+            with self.session() as ftp:
+                return func(ftp, item)
+
+        if len(items) == 1 or self.pool_size == 1:
+            return [run(item) for item in items]
+        with ThreadPoolExecutor(max_workers=min(self.pool_size, len(items))) as executor:
+            return list(executor.map(run, items))
+
+    def close(self):
+        while not self._idle.empty():
+            ftp, _ = self._idle.get()
+            try:
+                ftp.quit()
+            except ftplib.all_errors:
+                ftp.close()
+        self._opened = 0
@@ -1,6 +1,7 @@
 from config import *
 from colorama import Cursor, init
 import requests
+import shutil
 import sys
 
 
@@ -75,7 +76,7 @@ def delete_local_layer(name):
     for file in os.listdir(FILES_DIR):
         if file == name:
             try:
-                os.remove(file)
+                os.remove(os.path.join(FILES_DIR, file))
             except:
                 pass
 
@@ -85,7 +86,9 @@ Same logic that we apply in the function above, but in this case with a director
 """
 def delete_dir(name):
     try:
-        if os.path.exists(name):
+        if os.path.isdir(name):
+            shutil.rmtree(name)
+        elif os.path.exists(name):
             os.remove(name)
     except:
         pass